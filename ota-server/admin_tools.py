@@ -3,14 +3,20 @@
 Admin tools for OTA Update Server
 """
 import os
+import sys
+import json
+import hashlib
 import argparse
 from typing import Dict, Any, Optional
 
 import requests
 
 # Import utils from the main application
-from utils import calculate_file_md5, format_mac_address
-from config import load_config, get_config
+from utils import calculate_file_md5, format_mac_address, STREAM_CHUNK_SIZE
+from config import load_config, get_config, get_change_seq
+
+# In-process client used instead of HTTP in --direct mode
+_direct_client = None
 
 def get_admin_api_key() -> str:
     """Get the admin API key from config or environment"""
@@ -42,9 +48,16 @@ def make_admin_request(
     Returns:
         Response data as dict
     """
-    url = f"{get_server_url()}{endpoint}"
     api_key = get_admin_api_key()
     
+    # Direct mode: run the request in-process against the device store
+    if _direct_client is not None:
+        response = _direct_client.open(
+            endpoint, method=method, json=data, headers={"X-Admin-API-Key": api_key}
+        )
+        return check_admin_result(response.status_code, response.get_json(silent=True))
+    
+    url = f"{get_server_url()}{endpoint}"
     headers = {
         "X-Admin-API-Key": api_key,
         "Content-Type": "application/json"
@@ -63,21 +76,47 @@ def make_admin_request(
             print(f"Error: Unknown method {method}")
             return {"error": f"Unknown method {method}"}
         
-        # Parse JSON response
-        try:
-            result = response.json()
-        except ValueError:
-            result = {"error": "Invalid JSON response", "status_code": response.status_code}
-        
-        # Check for error status codes
-        if response.status_code >= 400:
-            print(f"Error {response.status_code}: {result.get('error', 'Unknown error')}")
-        
-        return result
+        return parse_admin_response(response)
     except requests.exceptions.RequestException as e:
         print(f"Request error: {e}")
         return {"error": str(e)}
 
+def parse_admin_response(response: requests.Response) -> Dict[str, Any]:
+    """
+    Parse an admin API response, printing any error it carries
+    
+    Args:
+        response: Response returned by the server
+        
+    Returns:
+        Response data as dict
+    """
+    try:
+        result = response.json()
+    except ValueError:
+        result = None
+    return check_admin_result(response.status_code, result)
+
+def check_admin_result(status_code: int, result: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Check a parsed admin API result, printing any error it carries
+    
+    Args:
+        status_code: HTTP status code of the response
+        result: Parsed JSON body, or None if it wasn't valid JSON
+        
+    Returns:
+        Response data as dict
+    """
+    if result is None:
+        result = {"error": "Invalid JSON response", "status_code": status_code}
+    
+    # Check for error status codes
+    if status_code >= 400:
+        print(f"Error {status_code}: {result.get('error', 'Unknown error')}")
+    
+    return result
+
 def list_devices_cmd(_args):
     """Command to list all devices"""
     print("Fetching device list...")
@@ -253,6 +292,186 @@ def delete_device_cmd(args):
     if "success" in result:
         print(f"Device {mac} deleted successfully.")
 
+def upload_firmware_cmd(args):
+    """Command to stream a firmware binary to the server"""
+    if not os.path.exists(args.file):
+        print(f"Error: File not found: {args.file}")
+        return
+        
+    if _direct_client is not None:
+        print("Error: upload needs a running server; use add/update --firmware-file in direct mode")
+        return
+        
+    filename = args.filename or os.path.basename(args.file)
+    params = {"filename": filename}
+    if args.overwrite:
+        params["overwrite"] = "1"
+    if args.version:
+        params["version"] = args.version
+    if args.hardware:
+        params["hardware"] = args.hardware
+    headers = {
+        "X-Admin-API-Key": get_admin_api_key(),
+        "Content-Type": "application/octet-stream"
+    }
+    if args.checksum:
+        # The server rejects a body that does not match before publishing it
+        headers["X-Firmware-Checksum"] = args.checksum
+        
+    # Hash while sending so the file is only read once
+    hash_md5 = hashlib.md5()
+    
+    def read_chunks():
+        with open(args.file, "rb") as f:
+            for chunk in iter(lambda: f.read(STREAM_CHUNK_SIZE), b""):
+                hash_md5.update(chunk)
+                yield chunk
+                
+    print(f"Uploading {args.file} as {filename}...")
+    try:
+        response = requests.post(
+            f"{get_server_url()}/admin/firmware",
+            params=params,
+            headers=headers,
+            data=read_chunks()
+        )
+    except requests.exceptions.RequestException as e:
+        print(f"Request error: {e}")
+        return
+        
+    result = parse_admin_response(response)
+    if "success" not in result:
+        return
+        
+    if result["checksum"] != hash_md5.hexdigest():
+        print(f"Error: Server stored checksum {result['checksum']} but local file is {hash_md5.hexdigest()}")
+        print("The stored file is corrupt; re-upload with --overwrite --checksum to replace it.")
+        return
+        
+    print(f"Uploaded {result['size']} bytes.")
+    print(f"Firmware URL: {result['firmware_url']}")
+    print(f"MD5 Checksum: {result['checksum']}")
+
+def gc_firmware_cmd(args):
+    """Command to delete firmware files outside the retention policy"""
+    data = {"dry_run": args.dry_run}
+    if args.keep is not None:
+        data["keep"] = args.keep
+        
+    result = make_admin_request("/admin/firmware/gc", method="POST", data=data)
+    if "deleted" not in result:
+        return
+        
+    action = "Would delete" if result["dry_run"] else "Deleted"
+    print(f"Keeping the newest {result['keep']} versions per hardware version.")
+    for filename in result["deleted"]:
+        print(f"  {action} {filename}")
+    print(f"{action} {len(result['deleted'])} files, freeing {result['bytes_freed']} bytes.")
+    for filename, count in sorted(result["referenced"].items()):
+        print(f"  Kept {filename}: referenced by {count} devices")
+    for filename in result["unknown_version"]:
+        print(f"  Kept {filename}: unknown version")
+
+def batch_cmd(args):
+    """Command to apply a list of device changes from a JSON file"""
+    try:
+        if args.file == "-":
+            operations = json.load(sys.stdin)
+        else:
+            with open(args.file, 'r', encoding='utf-8') as f:
+                operations = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Error: Could not read batch file: {e}")
+        return
+        
+    if not isinstance(operations, list):
+        print("Error: Batch file must contain a JSON list of operations")
+        return
+        
+    succeeded = 0
+    for index, operation in enumerate(operations, 1):
+        if not isinstance(operation, dict):
+            print(f"Error: Operation {index}: must be a JSON object")
+            continue
+            
+        action = operation.get("op")
+        raw_mac = operation.get("mac")
+        mac = format_mac_address(raw_mac) if isinstance(raw_mac, str) else ""
+        fields = {k: v for k, v in operation.items() if k not in ("op", "mac")}
+        if not mac:
+            print(f"Error: Operation {index}: invalid MAC address: {operation.get('mac')}")
+            continue
+            
+        if action == "add":
+            device_data = {
+                "mac_address": mac,
+                "device_id": f"device_{mac.replace(':', '')}",
+                "hardware_version": "1.0",
+                "last_check": None,
+                "last_update": None
+            }
+            device_data.update(fields)
+            result = make_admin_request("/admin/devices", method="POST", data=device_data)
+        elif action == "update":
+            device = make_admin_request(f"/admin/devices/{mac}")
+            if "error" in device:
+                continue
+            device.update(fields)
+            result = make_admin_request(f"/admin/devices/{mac}", method="PUT", data=device)
+        elif action == "delete":
+            result = make_admin_request(f"/admin/devices/{mac}", method="DELETE")
+        else:
+            print(f"Error: Operation {index}: unknown op: {action}")
+            continue
+            
+        if "success" in result:
+            succeeded += 1
+            
+    print(f"Applied {succeeded} of {len(operations)} operations.")
+
+def notify_server_reload():
+    """Ask the running server to reload the devices file"""
+    try:
+        response = requests.post(
+            f"{get_server_url()}/admin/reload",
+            headers={"X-Admin-API-Key": get_admin_api_key()},
+            timeout=5
+        )
+    except requests.exceptions.RequestException:
+        print("Server not reachable; it will pick up the changes on its next write, "
+              "SIGHUP or restart.")
+        return
+        
+    if response.status_code == 200:
+        print("Server reloaded the device store.")
+    else:
+        print(f"Server did not reload the device store (HTTP {response.status_code}); "
+              "send it SIGHUP or restart it.")
+
+def run_direct(args):
+    """
+    Run a command directly against the device store instead of over HTTP
+    
+    The devices file is locked for the duration of the command, all changes
+    are applied in memory and it is saved once at the end.
+    """
+    global _direct_client
+    
+    # Imported here so HTTP mode doesn't need the server's dependencies
+    from app import app
+    from config import batch_devices
+    
+    _direct_client = app.test_client()
+    start_seq = get_change_seq()["seq"]
+    try:
+        with batch_devices():
+            args.func(args)
+    finally:
+        _direct_client = None
+        
+    if get_change_seq()["seq"] != start_seq:
+        notify_server_reload()
+
 def calc_checksum_cmd(args):
     """Command to calculate MD5 checksum for a firmware file"""
     if not os.path.exists(args.file):
@@ -270,6 +489,8 @@ def main():
     
     # Create argument parser
     parser = argparse.ArgumentParser(description='OTA Update Server Admin Tools')
+    parser.add_argument('--direct', action='store_true',
+                        help='Open the device store directly instead of going through the server API')
     subparsers = parser.add_subparsers(dest='command', help='Command')
     
     # List devices command
@@ -308,6 +529,28 @@ def main():
     delete_parser.add_argument('mac', help='Device MAC address')
     delete_parser.set_defaults(func=delete_device_cmd)
     
+    # Upload firmware command
+    upload_parser = subparsers.add_parser('upload', help='Upload a firmware binary to the server')
+    upload_parser.add_argument('file', help='Path to the firmware binary file')
+    upload_parser.add_argument('--filename', help='Name to store the firmware under (defaults to the file name)')
+    upload_parser.add_argument('--checksum', help='Expected MD5 checksum; the server rejects the upload on mismatch')
+    upload_parser.add_argument('--overwrite', action='store_true',
+                               help='Replace an existing firmware file with different content')
+    upload_parser.add_argument('--version', help='Firmware version, recorded for retention')
+    upload_parser.add_argument('--hardware', help='Hardware version the firmware is built for')
+    upload_parser.set_defaults(func=upload_firmware_cmd)
+    
+    # Garbage-collect firmware
+    gc_parser = subparsers.add_parser('gc', help='Delete old firmware files no device uses')
+    gc_parser.add_argument('--keep', type=int, help='Versions to keep per hardware version (default from server config)')
+    gc_parser.add_argument('--dry-run', action='store_true', help='Only report what would be deleted')
+    gc_parser.set_defaults(func=gc_firmware_cmd)
+    
+    # Batch command
+    batch_parser = subparsers.add_parser('batch', help='Apply a list of device changes from a JSON file')
+    batch_parser.add_argument('file', help='Path to a JSON list of operations, or - for stdin')
+    batch_parser.set_defaults(func=batch_cmd)
+    
     # Calculate checksum command
     checksum_parser = subparsers.add_parser('checksum', help='Calculate MD5 checksum for a file')
     checksum_parser.add_argument('file', help='Path to the file')
@@ -317,7 +560,9 @@ def main():
     args = parser.parse_args()
     
     # Execute command
-    if hasattr(args, 'func'):
+    if hasattr(args, 'func') and args.direct:
+        run_direct(args)
+    elif hasattr(args, 'func'):
         args.func(args)
     else:
         parser.print_help()
@@ -2,65 +2,159 @@
 OTA Update Server for ESP32 devices - Main Application
 """
 import os
+import stat
+import signal
 import logging
+import time
+import tempfile
 from datetime import datetime
+from itertools import chain
 
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, g, request, jsonify, send_file
+from werkzeug.security import safe_join
+from werkzeug.utils import secure_filename
 
-from config import load_config, get_config, get_devices, get_device, update_device
+from config import (
+    load_config,
+    get_config,
+    get_devices,
+    get_device,
+    iter_devices_json,
+    update_device,
+    record_device_check,
+    batch_devices,
+    get_change_seq,
+    get_changes,
+    reload_devices,
+    request_reload,
+    CHANGES_MAX_WAIT
+)
+from capture import is_capturing, capture_request, start_capture
+from firmware_cache import get_firmware, invalidate_firmware, firmware_etag
+from firmware_index import ensure_index, record_firmware, file_references, collect_garbage
+from manifest import update_payload, NO_UPDATE, start_manifest_export
+from registry import CompactRegistry
+from mirror import (
+    is_mirror,
+    record_check,
+    local_firmware_url,
+    start_mirror_sync,
+    registry_manifest,
+    firmware_manifest,
+    apply_checks
+)
+from wire_format import (
+    JSON_MIMETYPE,
+    RESPONSE_MIMETYPES,
+    encode,
+    encode_check_response
+)
 from utils import (
     generate_auth_token, 
     compare_versions, 
     validate_mac_address,
-    validate_version
+    validate_version,
+    calculate_file_md5,
+    stream_to_file
 )
 
 # --- Flask App Setup ---
 app = Flask(__name__)
 
+# --- Request Capture ---
+
+@app.before_request
+def start_request_timer():
+    """Note when the request started, for request capture"""
+    if is_capturing():
+        g.capture_started = time.time()
+        g.capture_timer = time.perf_counter()
+
+@app.after_request
+def capture_response(response):
+    """Record the finished request when request capture is enabled"""
+    if is_capturing() and "capture_timer" in g:
+        duration = time.perf_counter() - g.capture_timer
+        capture_request(request, response, g.capture_started, duration, get_config())
+    return response
+
+# --- Response Encoding ---
+
+def negotiate_mimetype() -> str:
+    """Pick the response format from the Accept header; JSON unless a binary format is asked for"""
+    return request.accept_mimetypes.best_match(RESPONSE_MIMETYPES, default=JSON_MIMETYPE)
+
+def make_api_response(data, status_code: int = 200, short_keys: bool = False) -> Response:
+    """
+    Encode response data as JSON, MessagePack or CBOR, as negotiated
+    
+    Args:
+        data: Response data
+        status_code: HTTP status code
+        short_keys: Whether binary formats use short field names
+        
+    Returns:
+        Flask response
+    """
+    mimetype = negotiate_mimetype()
+    if mimetype == JSON_MIMETYPE:
+        response = jsonify(data)
+    else:
+        response = Response(encode(data, mimetype, short_keys), mimetype=mimetype)
+    response.status_code = status_code
+    response.vary.add('Accept')
+    return response
+
 # --- API Endpoints ---
 
-@app.route('/api/firmware', methods=['GET'])
-def check_firmware_update():
+def process_update_check(device_id, hardware, current_version_str, mac_address, auth_token):
     """
-    Handles firmware update check requests from devices.
+    Validate, authenticate and answer one device's update check.
+    
+    Records the device's last check time through record_device_check, so callers
+    can wrap several checks in batch_devices() to save them once.
+    
+    Args:
+        device_id: Device ID reported by the device
+        hardware: Hardware version reported by the device
+        current_version_str: Firmware version the device is running
+        mac_address: MAC address of the device
+        auth_token: Authentication token (the X-Device-Auth value)
+        
+    Returns:
+        Tuple of (response data, HTTP status code)
     """
-    # 1. Get parameters and headers
-    device_id = request.args.get('device_id')
-    hardware = request.args.get('hardware')
-    current_version_str = request.args.get('version')
-    mac_address = request.args.get('mac', '').upper()  # Ensure MAC is uppercase
-    auth_header = request.headers.get('X-Device-Auth')
+    mac_address = (mac_address or '').upper()  # Ensure MAC is uppercase
     timestamp = datetime.now().isoformat()
 
     log_prefix = f"[MAC: {mac_address or 'N/A'}]"
     logging.info("%s Received update check: device_id=%s, hardware=%s, version=%s", log_prefix, device_id, hardware, current_version_str)
 
     # 2. Basic validation
-    if not all([device_id, hardware, current_version_str, mac_address, auth_header]):
+    if not all([device_id, hardware, current_version_str, mac_address, auth_token]):
         logging.warning("%s Bad request - Missing parameters or auth header.", log_prefix)
-        return jsonify({"error": "Missing required parameters or auth header"}), 400
+        return {"error": "Missing required parameters or auth header"}, 400
 
     if not validate_mac_address(mac_address):
         logging.warning("%s Invalid MAC address format.", log_prefix)
-        return jsonify({"error": "Invalid MAC address format"}), 400
+        return {"error": "Invalid MAC address format"}, 400
 
     if not validate_version(current_version_str):
         logging.warning("%s Invalid version format: %s", log_prefix, current_version_str)
-        return jsonify({"error": "Invalid version format"}), 400
+        return {"error": "Invalid version format"}, 400
 
     # 3. Check if MAC is authorized
     device_info = get_device(mac_address)
     if not device_info:
         logging.warning("%s Unauthorized MAC address.", log_prefix)
-        return jsonify({"error": "Device not authorized"}), 403  # Forbidden
+        return {"error": "Device not authorized"}, 403  # Forbidden
 
     # 4. Authenticate device
     config = get_config()
     expected_token = generate_auth_token(mac_address, config["shared_secret_key"])
-    if not expected_token or auth_header.upper() != expected_token:
+    if not expected_token or auth_token.upper() != expected_token:
         logging.warning("%s Authentication failed.", log_prefix)
-        return jsonify({"error": "Authentication failed"}), 401  # Unauthorized
+        return {"error": "Authentication failed"}, 401  # Unauthorized
 
     logging.info("%s Authentication successful.", log_prefix)
 
@@ -72,44 +166,135 @@ def check_firmware_update():
         version_comparison = compare_versions(target_version_str, current_version_str)
     except Exception as e:
         logging.error("%s Error comparing versions: %s", log_prefix, e)
-        return jsonify({"error": "Version comparison error"}), 400
+        return {"error": "Version comparison error"}, 400
 
     # 7. Update device's last check timestamp
-    device_info["last_check"] = timestamp
-    update_device(mac_address, device_info)
+    record_device_check(mac_address, timestamp)
+    if is_mirror():
+        record_check(mac_address, timestamp)
 
     # 8. Prepare response
     if version_comparison > 0:
         # Update is available
         logging.info("%s Update available: Current=%s, Target=%s", log_prefix, current_version_str, target_version_str)
-        response_data = {
-            "update_available": True,
-            "firmware_version": target_version_str,
-            "firmware_url": device_info["firmware_url"],
-            "checksum": device_info["checksum"]
-        }
-        return jsonify(response_data), 200
+        firmware_url = None
+        if is_mirror():
+            firmware_url = local_firmware_url(device_info["firmware_url"], request.host_url)
+        return update_payload(device_info, firmware_url), 200
     else:
         # No update needed (or device has a newer version somehow)
         logging.info("%s No update needed. Current=%s, Target=%s", log_prefix, current_version_str, target_version_str)
-        response_data = {
-            "update_available": False
-        }
-        return jsonify(response_data), 200
+        return NO_UPDATE, 200
+
+@app.route('/api/firmware', methods=['GET'])
+def check_firmware_update():
+    """
+    Handles firmware update check requests from devices.
+    """
+    # 1. Get parameters and headers
+    response_data, status_code = process_update_check(
+        request.args.get('device_id'),
+        request.args.get('hardware'),
+        request.args.get('version'),
+        request.args.get('mac'),
+        request.headers.get('X-Device-Auth')
+    )
+    
+    mimetype = negotiate_mimetype()
+    if mimetype == JSON_MIMETYPE:
+        response = jsonify(response_data)
+    else:
+        # Binary responses are pre-encoded per release
+        response = Response(encode_check_response(response_data, mimetype), mimetype=mimetype)
+    response.status_code = status_code
+    response.vary.add('Accept')
+    return response
+
+# Fields of a batch entry; each must be a string when present
+BATCH_CHECK_FIELDS = ("device_id", "hardware", "version", "mac", "token")
+
+@app.route('/api/firmware/batch', methods=['POST'])
+def check_firmware_update_batch():
+    """
+    Handles update checks for many devices at once, e.g. from a gateway.
+    
+    The body is {"devices": [{"device_id", "hardware", "version", "mac",
+    "token"}, ...]}, where token is the device's X-Device-Auth value. All
+    last check times are saved in a single commit, and the response has a
+    result per device in request order.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get("devices"), list):
+        return jsonify({"error": "List of devices required"}), 400
+        
+    checks = data["devices"]
+    max_batch_size = get_config()["max_batch_size"]
+    if len(checks) > max_batch_size:
+        return jsonify({"error": f"Batch too large (max {max_batch_size} devices)"}), 413
+        
+    results = []
+    with batch_devices():
+        for check in checks:
+            if not isinstance(check, dict) or not all(
+                    isinstance(check.get(field), (str, type(None))) for field in BATCH_CHECK_FIELDS):
+                results.append({"status": 400, "error": "Invalid device entry"})
+                continue
+            response_data, status_code = process_update_check(
+                check.get('device_id'),
+                check.get('hardware'),
+                check.get('version'),
+                check.get('mac'),
+                check.get('token')
+            )
+            results.append({"mac": (check.get('mac') or '').upper(), "status": status_code, **response_data})
+            
+    return make_api_response({"results": results}, short_keys=True)
 
 @app.route('/firmware/<filename>', methods=['GET'])
 def download_firmware(filename):
     """
     Serves firmware binary files from the firmware directory.
+    
+    Hot files are served from an in-memory cache; others are sent with
+    send_file, which uses the WSGI server's zero-copy file wrapper where
+    available. With firmware_offload set, the transfer is handed to the
+    fronting reverse proxy instead.
     """
     config = get_config()
     firmware_dir = config.get("firmware_directory", "firmware")
     
-    # Make sure the directory exists
-    if not os.path.exists(firmware_dir):
-        os.makedirs(firmware_dir)
+    # Hidden files are in-progress uploads and the firmware index
+    path = safe_join(firmware_dir, filename)
+    if path is None or filename.startswith('.'):
+        return jsonify({"error": "Firmware not found"}), 404
+        
+    # Let the reverse proxy serve the file via an internal redirect
+    offload = config["firmware_offload"].lower()
+    if offload == "x-accel-redirect":
+        response = Response(mimetype='application/octet-stream')
+        response.headers['X-Accel-Redirect'] = f"{config['firmware_offload_prefix']}{filename}"
+        return response
+    if offload == "x-sendfile":
+        response = Response(mimetype='application/octet-stream')
+        response.headers['X-Sendfile'] = os.path.abspath(path)
+        return response
         
-    return send_from_directory(firmware_dir, filename)
+    try:
+        file_stat = os.stat(path)
+    except OSError:
+        return jsonify({"error": "Firmware not found"}), 404
+    if not stat.S_ISREG(file_stat.st_mode):
+        return jsonify({"error": "Firmware not found"}), 404
+        
+    cached = get_firmware(path, file_stat, config["firmware_cache_mb"] * 1024 * 1024)
+    if cached:
+        response = Response(cached.data, mimetype='application/octet-stream')
+        response.set_etag(firmware_etag(file_stat))
+        response.last_modified = file_stat.st_mtime
+        return response.make_conditional(request, accept_ranges=True, complete_length=cached.size)
+        
+    return send_file(os.path.abspath(path), mimetype='application/octet-stream', conditional=True,
+                     etag=firmware_etag(file_stat), last_modified=file_stat.st_mtime)
 
 # --- Admin API Routes ---
 
@@ -127,8 +312,20 @@ def list_devices():
     if not verify_admin_api_key():
         return jsonify({"error": "Unauthorized"}), 401
         
+    # Read the sequence first; replaying a change already in the snapshot is harmless
+    change_seq = get_change_seq()
     devices = get_devices()
-    return jsonify(devices), 200
+    if isinstance(devices, CompactRegistry) and negotiate_mimetype() == JSON_MIMETYPE:
+        # Snapshot references only; records are serialized one at a time,
+        # matching jsonify's output including its trailing newline
+        body = iter_devices_json(list(devices.items()), indent=None, sort_keys=True)
+        response = Response(chain(body, ("\n",)), mimetype=JSON_MIMETYPE)
+        response.vary.add('Accept')
+    else:
+        response = make_api_response(devices)
+    response.headers['X-Change-Epoch'] = change_seq["epoch"]
+    response.headers['X-Change-Seq'] = str(change_seq["seq"])
+    return response
 
 @app.route('/admin/devices/<mac_address>', methods=['GET'])
 def get_device_info(mac_address):
@@ -140,7 +337,7 @@ def get_device_info(mac_address):
     if not device_info:
         return jsonify({"error": "Device not found"}), 404
         
-    return jsonify(device_info), 200
+    return make_api_response(dict(device_info))
 
 @app.route('/admin/devices/<mac_address>', methods=['PUT'])
 def update_device_info(mac_address):
@@ -222,6 +419,196 @@ def add_device():
         
     return jsonify({"success": True}), 201
 
+@app.route('/admin/firmware', methods=['POST'])
+def upload_firmware():
+    """
+    Stream a firmware binary into the firmware directory.
+    
+    The body is written to a temporary file while its digests are computed,
+    then renamed into place. If an X-Firmware-Checksum header (MD5) is sent,
+    a body that does not match it is rejected. An existing file with
+    different content is only replaced when overwrite=1 is passed, since
+    devices may already point at it. Optional version and hardware query
+    parameters record the release the file belongs to for retention.
+    """
+    if not verify_admin_api_key():
+        return jsonify({"error": "Unauthorized"}), 401
+        
+    filename = secure_filename(request.args.get('filename', ''))
+    if not filename:
+        return jsonify({"error": "Invalid or missing filename"}), 400
+        
+    expected_checksum = request.headers.get('X-Firmware-Checksum', '').strip().lower()
+    overwrite = request.args.get('overwrite', '').lower() in ('1', 'true', 'yes')
+    
+    config = get_config()
+    firmware_dir = config.get("firmware_directory", "firmware")
+    if not os.path.exists(firmware_dir):
+        os.makedirs(firmware_dir)
+        
+    # Stage in the same directory so the final rename is atomic
+    fd, temp_path = tempfile.mkstemp(dir=firmware_dir, prefix=f".{filename}.", suffix=".part")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            digests = stream_to_file(request.stream, f)
+            
+        if digests["size"] == 0:
+            os.remove(temp_path)
+            return jsonify({"error": "Empty firmware body"}), 400
+            
+        if expected_checksum and digests["md5"] != expected_checksum:
+            os.remove(temp_path)
+            logging.warning("Firmware upload %s rejected: checksum %s does not match expected %s",
+                            filename, digests["md5"], expected_checksum)
+            return jsonify({"error": "Checksum mismatch", "checksum": digests["md5"]}), 400
+            
+        os.chmod(temp_path, 0o644)
+        target_path = os.path.join(firmware_dir, filename)
+        if overwrite:
+            os.replace(temp_path, target_path)
+        else:
+            # Link rather than rename so an existing file is never replaced
+            try:
+                os.link(temp_path, target_path)
+            except FileExistsError:
+                os.remove(temp_path)
+                if calculate_file_md5(target_path) != digests["md5"]:
+                    logging.warning("Firmware upload %s rejected: a different file already has that name", filename)
+                    return jsonify({"error": "Firmware already exists with different content",
+                                    "checksum": digests["md5"]}), 409
+            else:
+                os.remove(temp_path)
+        invalidate_firmware(target_path)
+        record_firmware(filename, request.args.get('version'), request.args.get('hardware'))
+    except Exception as e:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        logging.error("Error storing firmware upload %s: %s", filename, e)
+        return jsonify({"error": "Failed to store firmware"}), 500
+        
+    logging.info("Stored firmware %s (%d bytes, MD5 %s)", filename, digests["size"], digests["md5"])
+    return jsonify({
+        "success": True,
+        "filename": filename,
+        "firmware_url": f"{request.host_url}firmware/{filename}",
+        "checksum": digests["md5"],
+        "sha256": digests["sha256"],
+        "size": digests["size"]
+    }), 201
+
+@app.route('/admin/changes', methods=['GET'])
+def list_changes():
+    """List registry changes after a sequence number, long-polling if there are none yet"""
+    if not verify_admin_api_key():
+        return jsonify({"error": "Unauthorized"}), 401
+        
+    try:
+        since = int(request.args.get('since', 0))
+        wait = float(request.args.get('wait', 0))
+    except ValueError:
+        return jsonify({"error": "Invalid since or wait parameter"}), 400
+        
+    wait = min(max(wait, 0), CHANGES_MAX_WAIT)
+    return make_api_response(get_changes(since, wait, request.args.get('epoch')))
+
+@app.route('/admin/reload', methods=['POST'])
+def reload_device_store():
+    """Reload the devices file after it was changed outside the server"""
+    if not verify_admin_api_key():
+        return jsonify({"error": "Unauthorized"}), 401
+        
+    devices = reload_devices()
+    return jsonify({"success": True, "devices": len(devices)}), 200
+
+@app.route('/admin/firmware/gc', methods=['POST'])
+def firmware_gc():
+    """Delete firmware files outside the retention policy"""
+    if not verify_admin_api_key():
+        return jsonify({"error": "Unauthorized"}), 401
+        
+    data = request.get_json(silent=True)
+    if data is None:
+        data = {}
+    if not isinstance(data, dict):
+        return jsonify({"error": "Body must be a JSON object"}), 400
+        
+    keep = data.get("keep", get_config()["firmware_keep_versions"])
+    if not isinstance(keep, int) or isinstance(keep, bool) or keep < 1:
+        return jsonify({"error": "keep must be a positive integer"}), 400
+        
+    report = collect_garbage(keep, dry_run=bool(data.get("dry_run")))
+    return jsonify(report), 200
+
+@app.route('/admin/firmware/<filename>/references', methods=['GET'])
+def firmware_references(filename):
+    """List the devices and releases using a firmware file"""
+    if not verify_admin_api_key():
+        return jsonify({"error": "Unauthorized"}), 401
+        
+    return jsonify(file_references(filename)), 200
+
+# --- Mirror Sync Routes ---
+
+@app.route('/admin/sync/manifest', methods=['GET'])
+def sync_manifest():
+    """
+    Digests of all device records and firmware files, for mirrors
+    
+    The change feed position is taken before the digests are computed, so a
+    mirror that follows /admin/changes from it misses nothing.
+    """
+    if not verify_admin_api_key():
+        return jsonify({"error": "Unauthorized"}), 401
+        
+    config = get_config()
+    return jsonify({
+        **get_change_seq(),
+        "devices": registry_manifest(),
+        "firmware": firmware_manifest(config.get("firmware_directory", "firmware"))
+    }), 200
+
+@app.route('/admin/sync/firmware', methods=['GET'])
+def sync_firmware():
+    """Checksums of all firmware files, for mirrors between full syncs"""
+    if not verify_admin_api_key():
+        return jsonify({"error": "Unauthorized"}), 401
+        
+    config = get_config()
+    return jsonify(firmware_manifest(config.get("firmware_directory", "firmware"))), 200
+
+@app.route('/admin/sync/devices', methods=['POST'])
+def sync_devices():
+    """Full records for the requested MAC addresses, for mirrors"""
+    if not verify_admin_api_key():
+        return jsonify({"error": "Unauthorized"}), 401
+        
+    data = request.json
+    if not data or not isinstance(data.get("macs"), list):
+        return jsonify({"error": "List of MAC addresses required"}), 400
+        
+    devices = get_devices()
+    records = {}
+    for mac in data["macs"]:
+        mac_upper = str(mac).upper()
+        if mac_upper in devices:
+            records[mac_upper] = dict(devices[mac_upper])
+    return jsonify(records), 200
+
+@app.route('/admin/sync/checks', methods=['POST'])
+def sync_checks():
+    """Apply a batch of last_check timestamps forwarded by a mirror"""
+    if not verify_admin_api_key():
+        return jsonify({"error": "Unauthorized"}), 401
+        
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get("checks"), dict):
+        return jsonify({"error": "Check timestamps required"}), 400
+    if not all(isinstance(timestamp, str) for timestamp in data["checks"].values()):
+        return jsonify({"error": "Check timestamps must be strings"}), 400
+        
+    updated = apply_checks(data["checks"])
+    return jsonify({"success": True, "updated": updated}), 200
+
 # --- Status Endpoint ---
 @app.route('/status', methods=['GET'])
 def status():
@@ -245,6 +632,30 @@ def main():
         format='%(asctime)s - %(levelname)s - %(message)s'
     )
     
+    # Create the firmware directory once rather than on every download
+    firmware_dir = config.get("firmware_directory", "firmware")
+    if not os.path.exists(firmware_dir):
+        os.makedirs(firmware_dir)
+    
+    # Build the firmware reference index; it is then kept current as devices change
+    ensure_index()
+    
+    # Reload the devices file on SIGHUP (e.g. after admin_tools.py --direct)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, request_reload)
+    
+    # Record requests for later replay
+    if config["capture_file"]:
+        start_capture(config)
+    
+    # Keep static update manifests in step with the registry
+    if config["manifest_directory"]:
+        start_manifest_export()
+    
+    # Keep the local registry and firmware in sync with the primary
+    if is_mirror():
+        start_mirror_sync()
+    
     # Start server
     logging.info("Starting OTA Update Server...")
     app.run(
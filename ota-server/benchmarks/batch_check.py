@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Update-check throughput benchmark: single checks vs the batched endpoint
+
+Runs the app in-process (Flask test client) against a temporary devices file
+and reports devices checked per second for increasing batch sizes. Each
+single check saves devices.json; each batch saves it once.
+
+Usage:
+    python benchmarks/batch_check.py [--devices 2000] [--batch-sizes 1 10 100 1000]
+"""
+import os
+import time
+import logging
+import argparse
+
+from common import make_workdir, make_macs, write_config, write_json
+
+import config
+from app import app
+from utils import generate_auth_token
+
+SECRET = "bench-secret"
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description='Batched update-check benchmark')
+    parser.add_argument('--devices', type=int, default=2000, help='Devices in the registry')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 10, 100, 1000],
+                        help='Devices per batch request')
+    args = parser.parse_args()
+
+    os.chdir(make_workdir())
+    macs = make_macs(args.devices)
+    devices = {mac: {
+        "device_id": f"panic_button_{i}",
+        "hardware_version": "1.0",
+        "target_version": "1.3.0",
+        "firmware_url": "http://ota.example.com/firmware/PanicButton_v1.3.0.bin",
+        "checksum": "e10adc3949ba59abbe56e057f20f883e",
+        "last_check": None,
+        "last_update": None
+    } for i, mac in enumerate(macs)}
+    write_json("devices.json", devices)
+    config.load_config(write_config({"shared_secret_key": SECRET, "log_level": "WARNING",
+                                     "max_batch_size": max(args.batch_sizes)}))
+    logging.getLogger().setLevel(logging.WARNING)
+
+    client = app.test_client()
+    checks = [{"device_id": f"panic_button_{i}", "hardware": "1.0", "version": "1.2.0",
+               "mac": mac, "token": generate_auth_token(mac, SECRET)} for i, mac in enumerate(macs)]
+
+    # Baseline: one GET /api/firmware per device
+    start = time.perf_counter()
+    for check in checks:
+        client.get('/api/firmware', query_string={k: v for k, v in check.items() if k != "token"},
+                   headers={"X-Device-Auth": check["token"]})
+    single_rate = len(checks) / (time.perf_counter() - start)
+
+    print(f"{args.devices} devices in registry")
+    print(f"{'Mode':<18} {'devices/s':>12} {'ms/request':>12}")
+    print("-" * 44)
+    print(f"{'single GET':<18} {single_rate:>12.0f} {1000 / single_rate:>12.2f}")
+    for size in args.batch_sizes:
+        batches = [checks[i:i + size] for i in range(0, len(checks), size)]
+        start = time.perf_counter()
+        for batch in batches:
+            response = client.post('/api/firmware/batch', json={"devices": batch})
+            assert response.status_code == 200
+        elapsed = time.perf_counter() - start
+        print(f"{f'batch of {size}':<18} {len(checks) / elapsed:>12.0f} "
+              f"{elapsed / len(batches) * 1000:>12.2f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+"""
+Shared scaffolding for the benchmark scripts
+
+Importing this module puts the server directory on sys.path, so benchmarks
+import it before any server module.
+"""
+import os
+import sys
+import json
+import tempfile
+from typing import Any, Dict, List
+
+SERVER_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+if SERVER_DIR not in sys.path:
+    sys.path.insert(0, SERVER_DIR)
+
+def make_workdir() -> str:
+    """Create a temporary directory for a benchmark run"""
+    return tempfile.mkdtemp(prefix="ota-bench-")
+
+def write_json(path: str, data: Any) -> None:
+    """Write a JSON file, such as a devices.json"""
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+
+def write_config(settings: Dict[str, Any], directory: str = ".") -> str:
+    """
+    Write a server config.json
+
+    Args:
+        settings: Config values; anything left out takes the server's default
+        directory: Directory to write it in
+
+    Returns:
+        Path of the config file
+    """
+    path = os.path.join(directory, "config.json")
+    write_json(path, settings)
+    return path
+
+def make_macs(count: int) -> List[str]:
+    """Sequential MAC addresses for a synthetic fleet"""
+    macs = []
+    for i in range(count):
+        mac_hex = format(0x24A160000000 + i, '012X')
+        macs.append(':'.join(mac_hex[j:j+2] for j in range(0, 12, 2)))
+    return macs
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Concurrent firmware download benchmark: disk (send_file) vs hot cache
+
+Starts the OTA server in-process on a threaded WSGI server and downloads the
+same firmware image from many concurrent clients, as happens during a rollout.
+
+Usage:
+    python benchmarks/firmware_download.py [--size-kb 1024] [--requests 400] [--concurrency 1 8 32]
+"""
+import os
+import time
+import logging
+import argparse
+import threading
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from werkzeug.serving import make_server
+
+from common import make_workdir, write_config
+
+import config
+from app import app
+from firmware_cache import clear_firmware_cache
+
+def run(url: str, total: int, concurrency: int) -> dict:
+    """Download `url` `total` times from `concurrency` clients"""
+    local = threading.local()
+
+    def download(_):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        start = time.perf_counter()
+        response = local.session.get(url)
+        elapsed = time.perf_counter() - start
+        if response.status_code != 200:
+            raise RuntimeError(f"HTTP {response.status_code}")
+        return elapsed, len(response.content)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(download, range(total)))
+    wall = time.perf_counter() - start
+
+    latencies = sorted(r[0] for r in results)
+    return {
+        "rps": total / wall,
+        "mbps": sum(r[1] for r in results) / wall / 2**20,
+        "p50": statistics.median(latencies) * 1000,
+        "p99": latencies[int(len(latencies) * 0.99) - 1] * 1000
+    }
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description='Firmware download benchmark')
+    parser.add_argument('--size-kb', type=int, default=1024, help='Firmware image size in KB')
+    parser.add_argument('--requests', type=int, default=400, help='Downloads per run')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32],
+                        help='Concurrent clients per run')
+    args = parser.parse_args()
+
+    os.chdir(make_workdir())
+    os.makedirs("firmware")
+    with open(os.path.join("firmware", "bench.bin"), "wb") as f:
+        f.write(os.urandom(args.size_kb * 1024))
+    config.load_config(write_config({"log_level": "WARNING", "devices_file": "devices.json"}))
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/firmware/bench.bin"
+
+    print(f"{args.size_kb} KB image, {args.requests} downloads per run")
+    print(f"{'Mode':<8} {'Clients':>8} {'req/s':>10} {'MB/s':>10} {'p50 ms':>10} {'p99 ms':>10}")
+    print("-" * 60)
+    for mode, cache_mb in (("disk", 0), ("cache", 64)):
+        config.get_config()["firmware_cache_mb"] = cache_mb
+        for concurrency in args.concurrency:
+            clear_firmware_cache()
+            result = run(url, args.requests, concurrency)
+            print(f"{mode:<8} {concurrency:>8} {result['rps']:>10.1f} {result['mbps']:>10.1f} "
+                  f"{result['p50']:>10.2f} {result['p99']:>10.2f}")
+
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
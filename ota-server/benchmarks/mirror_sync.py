@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Mirror sync benchmark against a separate primary server process
+
+Starts a primary OTA server as a subprocess with a temporary registry and
+firmware directory, then runs the mirror side in-process and times a full
+initial sync, an incremental sync after some devices change on the primary,
+forwarding of last_check timestamps back to the primary, and the full resync
+that follows a primary restart. After each step
+the mirror is compared with the primary; the script exits non-zero if they
+disagree.
+
+Usage:
+    python benchmarks/mirror_sync.py [--devices 2000] [--changed 100] [--firmware-kb 1024]
+"""
+import os
+import sys
+import time
+import socket
+import logging
+import argparse
+import subprocess
+from datetime import datetime
+
+import requests
+
+from common import SERVER_DIR, make_workdir, make_macs, write_config, write_json
+
+import config
+import mirror
+from utils import calculate_file_md5
+
+ADMIN_KEY = "bench-admin-key"
+
+def free_port() -> int:
+    """Pick an unused local TCP port"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_primary(workdir: str, port: int) -> subprocess.Popen:
+    """Start the primary server process and wait until it answers"""
+    write_config({"server_host": "127.0.0.1", "server_port": port, "admin_api_key": ADMIN_KEY,
+                  "log_level": "WARNING"}, workdir)
+    process = subprocess.Popen([sys.executable, os.path.join(SERVER_DIR, "app.py")], cwd=workdir,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            requests.get(f"http://127.0.0.1:{port}/status", timeout=1)
+            return process
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Primary server did not start")
+
+def check_in_sync(primary_url: str) -> None:
+    """Compare the mirror's registry and firmware with the primary's"""
+    primary = requests.get(f"{primary_url}/admin/sync/manifest",
+                           headers={"X-Admin-API-Key": ADMIN_KEY}, timeout=30).json()
+    local_devices = mirror.registry_manifest()
+    if local_devices != primary["devices"]:
+        raise RuntimeError(f"Registry differs: {len(local_devices)} devices on mirror, "
+                           f"{len(primary['devices'])} on primary")
+    local_firmware = mirror.firmware_manifest(config.get_config()["firmware_directory"])
+    if local_firmware != primary["firmware"]:
+        raise RuntimeError("Firmware directory differs from primary")
+
+def timed(label: str, func) -> dict:
+    """Run one sync step and print how long it took"""
+    start = time.perf_counter()
+    stats = func()
+    elapsed = (time.perf_counter() - start) * 1000
+    print(f"{label:<22} {elapsed:>10.1f} {stats['devices']:>9} {stats['removed']:>9} "
+          f"{stats['firmware']:>9} {stats['checks']:>9}")
+    return stats
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description='Mirror sync benchmark')
+    parser.add_argument('--devices', type=int, default=2000, help='Devices in the primary registry')
+    parser.add_argument('--changed', type=int, default=100, help='Devices changed before the incremental sync')
+    parser.add_argument('--firmware-kb', type=int, default=1024, help='Firmware image size in KB')
+    args = parser.parse_args()
+
+    root = make_workdir()
+    primary_dir = os.path.join(root, "primary")
+    mirror_dir = os.path.join(root, "mirror")
+    os.makedirs(os.path.join(primary_dir, "firmware"))
+    os.makedirs(mirror_dir)
+
+    port = free_port()
+    primary_url = f"http://127.0.0.1:{port}"
+    firmware_path = os.path.join(primary_dir, "firmware", "PanicButton_v1.3.0.bin")
+    with open(firmware_path, "wb") as f:
+        f.write(os.urandom(args.firmware_kb * 1024))
+    macs = make_macs(args.devices)
+    devices = {mac: {
+        "device_id": f"panic_button_{i}",
+        "hardware_version": "1.0",
+        "target_version": "1.3.0",
+        "firmware_url": f"{primary_url}/firmware/PanicButton_v1.3.0.bin",
+        "checksum": calculate_file_md5(firmware_path),
+        "last_check": None,
+        "last_update": None
+    } for i, mac in enumerate(macs)}
+    write_json(os.path.join(primary_dir, "devices.json"), devices)
+
+    process = start_primary(primary_dir, port)
+    try:
+        os.chdir(mirror_dir)
+        write_json("devices.json", {})
+        config.load_config(write_config({"mirror_primary_url": primary_url, "mirror_api_key": ADMIN_KEY,
+                                         "log_level": "WARNING"}))
+        logging.getLogger().setLevel(logging.WARNING)
+
+        print(f"{args.devices} devices, {args.firmware_kb} KB firmware, primary on port {port}")
+        print(f"{'Step':<22} {'ms':>10} {'devices':>9} {'removed':>9} {'firmware':>9} {'checks':>9}")
+        print("-" * 72)
+
+        stats = timed("initial sync", mirror.sync_once)
+        if stats["devices"] != args.devices or stats["firmware"] != 1:
+            raise RuntimeError(f"Initial sync incomplete: {stats}")
+        check_in_sync(primary_url)
+
+        timed("no-op sync", mirror.sync_once)
+        check_in_sync(primary_url)
+
+        # Change some devices on the primary and delete one
+        session = requests.Session()
+        session.headers["X-Admin-API-Key"] = ADMIN_KEY
+        for mac in macs[:args.changed]:
+            session.put(f"{primary_url}/admin/devices/{mac}",
+                        json=dict(devices[mac], target_version="1.4.0")).raise_for_status()
+        session.delete(f"{primary_url}/admin/devices/{macs[-1]}").raise_for_status()
+        stats = timed("incremental sync", mirror.sync_once)
+        if stats["devices"] != args.changed or stats["removed"] != 1:
+            raise RuntimeError(f"Incremental sync incomplete: {stats}")
+        check_in_sync(primary_url)
+
+        # Checks answered by the mirror are forwarded to the primary
+        timestamp = datetime.now().isoformat()
+        for mac in macs[:args.changed]:
+            mirror.record_check(mac, timestamp)
+        stats = timed("forward checks", mirror.sync_once)
+        forwarded = session.get(f"{primary_url}/admin/devices/{macs[0]}").json()
+        if stats["checks"] != args.changed or forwarded.get("last_check") != timestamp:
+            raise RuntimeError("last_check timestamps were not forwarded to the primary")
+
+        # A restarted primary has a new change feed epoch; the mirror falls back to a full sync
+        epoch = mirror._feed_epoch
+        process.terminate()
+        process.wait()
+        process = start_primary(primary_dir, port)
+        stats = timed("resync after restart", mirror.sync_once)
+        if mirror._feed_epoch == epoch or stats["devices"] or stats["removed"]:
+            raise RuntimeError(f"Resync after primary restart incorrect: {stats}")
+        check_in_sync(primary_url)
+        print("Mirror matches primary after every step.")
+    except (RuntimeError, requests.exceptions.RequestException) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    finally:
+        process.terminate()
+        process.wait()
+
+if __name__ == '__main__':
+    main()
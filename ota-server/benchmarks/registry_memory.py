@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Memory benchmark: plain dict-of-dicts registry vs CompactRegistry
+
+Builds a synthetic fleet the way load_devices() does (from parsed JSON) and
+reports the memory retained by each representation, measured with tracemalloc.
+
+Usage:
+    python benchmarks/registry_memory.py [--sizes 10000 100000 1000000]
+"""
+import gc
+import json
+import hashlib
+import argparse
+import tracemalloc
+from typing import Any, Callable, Dict
+
+from common import make_macs
+
+from registry import CompactRegistry
+
+def make_fleet(count: int) -> str:
+    """Build a devices.json document for `count` devices spread over a few releases"""
+    releases = [f"1.{minor}.{patch}" for minor in range(5) for patch in range(4)]
+    hardware = ["1.0", "1.1", "2.0"]
+    devices = {}
+    for i, mac in enumerate(make_macs(count)):
+        version = releases[i % len(releases)]
+        devices[mac] = {
+            "device_id": f"panic_button_{i:07d}",
+            "hardware_version": hardware[i % len(hardware)],
+            "target_version": version,
+            "firmware_url": f"http://ota.example.com/firmware/PanicButton_v{version}.bin",
+            "checksum": hashlib.md5(version.encode()).hexdigest(),
+            "last_check": f"2024-05-{i % 28 + 1:02d}T10:{i % 60:02d}:{i % 60:02d}.{i % 1000000:06d}",
+            "last_update": None
+        }
+    return json.dumps(devices)
+
+def measure(build: Callable[[], Any]) -> int:
+    """Bytes retained by the object returned from `build`"""
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    gc.collect()
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return retained
+
+def plain_registry(document: str) -> Dict[str, Dict[str, Any]]:
+    """Registry as load_devices() builds it today"""
+    devices = json.loads(document)
+    return {mac.upper(): info for mac, info in devices.items()}
+
+def compact_registry(document: str) -> CompactRegistry:
+    """Registry as load_devices() builds it with compact_registry enabled"""
+    return CompactRegistry(plain_registry(document))
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description='Registry memory benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help='Fleet sizes to measure')
+    args = parser.parse_args()
+
+    print(f"{'Devices':>10} {'dict-of-dicts':>15} {'compact':>15} {'saved':>8} {'bytes/dev':>15}")
+    print("-" * 68)
+    for size in args.sizes:
+        document = make_fleet(size)
+        plain = measure(lambda: plain_registry(document))
+        compact = measure(lambda: compact_registry(document))
+        print(f"{size:>10} {plain / 2**20:>12.1f} MB {compact / 2**20:>12.1f} MB "
+              f"{1 - compact / plain:>7.0%} {plain // size:>6} -> {compact // size:<6}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""
+Replay captured production traffic against a local OTA server
+
+Plays a capture written by the server's request capture mode (capture_file)
+with its original timing, sped up, or as fast as possible, and reports the
+latency distribution and errors per route. A request counts as an error if
+it fails or returns a different status than it did when captured.
+
+Device tokens and the admin API key are regenerated from the target server's
+config, so captured valid and invalid auth replay as valid and invalid. Use
+--seed-devices to write a devices.json containing the captured devices, so an
+anonymized capture can be replayed against a scratch server.
+
+Admin requests that destroy data on the target (firmware uploads, which are
+replayed as zero-filled bodies, firmware garbage collection and device
+deletion) are skipped unless --allow-destructive is given.
+
+Usage:
+    python benchmarks/replay.py capture.jsonl [--speed 1|10|max] [--concurrency 64]
+    python benchmarks/replay.py capture.jsonl --seed-devices devices.json
+"""
+import json
+import time
+import argparse
+import threading
+import statistics
+from collections import Counter, defaultdict
+from functools import cmp_to_key
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import common  # noqa: F401  Puts the server modules on sys.path
+
+import config
+from utils import generate_auth_token, compare_versions, validate_version
+
+# Stand-in for a captured invalid token or API key
+INVALID_SECRET = "invalid"
+
+# Admin routes that overwrite or delete data on the target, as (method, rule)
+DESTRUCTIVE_ROUTES = {
+    ("POST", "/admin/firmware"),
+    ("POST", "/admin/firmware/gc"),
+    ("DELETE", "/admin/devices/<mac_address>")
+}
+
+def load_capture(path: str, limit: int = 0) -> list:
+    """Read capture records, in order of their start time"""
+    records = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+            if limit and len(records) >= limit:
+                break
+    records.sort(key=lambda record: record["t"])
+    return records
+
+def device_token(mac, outcome, secret: str) -> str:
+    """Regenerate a device token with the captured outcome"""
+    if outcome == "ok" and mac:
+        return generate_auth_token(mac.upper(), secret)
+    return INVALID_SECRET
+
+def build_request(record: dict, secret: str, admin_key: str) -> dict:
+    """
+    Turn a capture record back into request arguments
+
+    Args:
+        record: Capture record
+        secret: Target server's shared secret, for device tokens
+        admin_key: Target server's admin API key
+
+    Returns:
+        Keyword arguments for requests.Session.request
+    """
+    headers = dict(record.get("h", {}))
+    auth = record.get("a", {})
+    if "device" in auth:
+        headers["X-Device-Auth"] = device_token(record.get("q", {}).get("mac"), auth["device"], secret)
+    if "admin" in auth:
+        headers["X-Admin-API-Key"] = admin_key if auth["admin"] == "ok" else INVALID_SECRET
+
+    kwargs = {"method": record["m"], "params": record.get("q"), "headers": headers}
+    if "b" in record:
+        body = record["b"]
+        if isinstance(body, dict) and isinstance(body.get("devices"), list):
+            body = dict(body, devices=[
+                dict(check, token=device_token(check.get("mac"), check["token"], secret))
+                if isinstance(check, dict) and check.get("token") else check
+                for check in body["devices"]
+            ])
+        kwargs["json"] = body
+    elif "n" in record:
+        # Binary bodies (firmware uploads) are not captured; send the same amount of data
+        kwargs["data"] = bytes(record["n"])
+        headers["Content-Type"] = "application/octet-stream"
+    return kwargs
+
+def replay(records: list, url: str, speed: float, concurrency: int,
+           secret: str, admin_key: str) -> tuple:
+    """
+    Play capture records against a server
+
+    Args:
+        records: Capture records, in order
+        url: Base URL of the target server
+        speed: Playback speed relative to the capture; 0 for as fast as possible
+        concurrency: Maximum requests in flight
+        secret: Target server's shared secret
+        admin_key: Target server's admin API key
+
+    Returns:
+        Tuple of (results, wall time); each result is (record, latency, status,
+        error, lag), where lag is how late the request started
+    """
+    local = threading.local()
+
+    def send(item):
+        record, scheduled = item
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        start = time.perf_counter()
+        lag = max(0.0, start - scheduled) if scheduled else 0.0
+        try:
+            response = local.session.request(url=url + record["p"], timeout=60,
+                                             **build_request(record, secret, admin_key))
+            status, error = response.status_code, None
+        except requests.exceptions.RequestException as e:
+            status, error = None, type(e).__name__
+        return record, time.perf_counter() - start, status, error, lag
+
+    first = records[0]["t"] if records else 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        if speed:
+            futures = []
+            for record in records:
+                scheduled = start + (record["t"] - first) / speed
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                futures.append(pool.submit(send, (record, scheduled)))
+            results = [future.result() for future in futures]
+        else:
+            results = list(pool.map(send, ((record, None) for record in records)))
+    return results, time.perf_counter() - start
+
+def percentile(values: list, fraction: float) -> float:
+    """Nearest-rank percentile of sorted values"""
+    return values[max(0, int(round(len(values) * fraction)) - 1)]
+
+def report(results: list, wall: float, captured_span: float) -> None:
+    """Print latency distributions and errors per route"""
+    by_route = defaultdict(list)
+    for result in results:
+        record = result[0]
+        by_route[f"{record['m']} {record['r'] or '(unmatched)'}"].append(result)
+
+    total = len(results)
+    print(f"Replayed {total} requests in {wall:.1f}s ({total / wall if wall else 0:.1f} req/s); "
+          f"captured span {captured_span:.1f}s")
+    print()
+    print(f"{'Route':<42} {'count':>7} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8} "
+          f"{'cap p50':>8} {'errors':>7}")
+    print("-" * 104)
+    mismatches = Counter()
+    failures = Counter()
+    for route, route_results in sorted(by_route.items(), key=lambda item: -len(item[1])):
+        latencies = sorted(result[1] * 1000 for result in route_results)
+        captured = sorted(result[0]["d"] for result in route_results)
+        errors = 0
+        for record, _, status, error, _ in route_results:
+            if error:
+                failures[(route, error)] += 1
+                errors += 1
+            elif status != record["s"]:
+                mismatches[(route, record["s"], status)] += 1
+                errors += 1
+        print(f"{route[:42]:<42} {len(route_results):>7} {percentile(latencies, 0.5):>8.2f} "
+              f"{percentile(latencies, 0.9):>8.2f} {percentile(latencies, 0.99):>8.2f} "
+              f"{latencies[-1]:>8.2f} {statistics.median(captured):>8.2f} {errors:>7}")
+
+    lags = sorted(result[4] * 1000 for result in results)
+    if lags and lags[-1]:
+        print()
+        print(f"Start lag behind schedule: p50 {percentile(lags, 0.5):.1f} ms, "
+              f"p99 {percentile(lags, 0.99):.1f} ms, max {lags[-1]:.1f} ms")
+    if failures or mismatches:
+        print()
+        print("Errors:")
+        for (route, error), count in failures.most_common():
+            print(f"  {count:>6}  {route}: {error}")
+        for (route, expected, status), count in mismatches.most_common():
+            print(f"  {count:>6}  {route}: status {status}, captured {expected}")
+
+def seed_devices(records: list, base_url: str) -> dict:
+    """
+    Build a device registry containing the devices seen in a capture
+
+    Each hardware version's target is the newest version any device reported,
+    so devices that were behind still get update responses. Devices the server
+    rejected as unknown when the capture was taken are left out.
+
+    Args:
+        records: Capture records
+        base_url: Base URL for firmware links
+
+    Returns:
+        Devices dict in the devices.json shape
+    """
+    checks = {}
+    unknown = set()
+    newest = {}
+    downloads = Counter()
+    for record in records:
+        found = []
+        if record["r"] == "/api/firmware" and "q" in record:
+            if record["s"] == 403:
+                unknown.add(record["q"].get("mac", "").upper())
+            else:
+                found.append(record["q"])
+        elif record["r"] == "/api/firmware/batch" and isinstance(record.get("b"), dict):
+            found.extend(check for check in record["b"].get("devices") or ()
+                         if isinstance(check, dict) and check.get("mac"))
+        elif record["r"] == "/firmware/<filename>" and record["s"] in (200, 206):
+            downloads[record["p"].rsplit("/", 1)[-1]] += 1
+
+        for check in found:
+            checks[check.get("mac", "").upper()] = check
+            version = check.get("version")
+            if validate_version(version or ""):
+                hardware = check.get("hardware") or "1.0"
+                newest[hardware] = max(newest.get(hardware, version), version, key=cmp_to_key(compare_versions))
+
+    filename = downloads.most_common(1)[0][0] if downloads else "firmware.bin"
+    devices = {}
+    for mac, check in checks.items():
+        if not mac or mac in unknown:
+            continue
+        hardware = check.get("hardware") or "1.0"
+        devices[mac] = {
+            "device_id": check.get("device_id") or f"device_{mac.replace(':', '')}",
+            "hardware_version": hardware,
+            "target_version": newest.get(hardware, "1.0.0"),
+            "firmware_url": f"{base_url}/firmware/{filename}",
+            "checksum": "0" * 32,
+            "last_check": None,
+            "last_update": None
+        }
+    return devices
+
+def parse_speed(value: str) -> float:
+    """Parse a playback speed: a multiplier such as 1 or 10, or max"""
+    if value.lower() == "max":
+        return 0.0
+    speed = float(value.lower().rstrip("x"))
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("speed must be positive or max")
+    return speed
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description='Replay captured traffic against an OTA server')
+    parser.add_argument('capture', help='Capture file written by the server (capture_file)')
+    parser.add_argument('--url', help='Target server URL (default: from the config file)')
+    parser.add_argument('--config', default='config.json',
+                        help="Target server's config file, for its shared secret and admin API key")
+    parser.add_argument('--speed', type=parse_speed, default=1.0,
+                        help='Playback speed: 1 for real time, 10 for ten times faster, max for no pacing')
+    parser.add_argument('--concurrency', type=int, default=64, help='Maximum requests in flight')
+    parser.add_argument('--limit', type=int, default=0, help='Replay only the first N records')
+    parser.add_argument('--no-admin', action='store_true', help='Skip admin API requests')
+    parser.add_argument('--allow-destructive', action='store_true',
+                        help='Also replay firmware uploads, firmware GC and device deletions')
+    parser.add_argument('--seed-devices', metavar='FILE',
+                        help='Write a devices.json with the captured devices instead of replaying')
+    args = parser.parse_args()
+
+    server_config = config.load_config(args.config)
+    url = (args.url or f"http://127.0.0.1:{server_config['server_port']}").rstrip("/")
+
+    records = load_capture(args.capture, args.limit)
+    if args.no_admin:
+        records = [record for record in records if not record["p"].startswith("/admin/")]
+    if not args.allow_destructive:
+        kept = [record for record in records if (record["m"], record["r"]) not in DESTRUCTIVE_ROUTES]
+        if len(kept) < len(records):
+            print(f"Skipping {len(records) - len(kept)} destructive admin requests (see --allow-destructive)")
+        records = kept
+    if not records:
+        print("Error: No requests to replay")
+        return
+
+    if args.seed_devices:
+        devices = seed_devices(records, url)
+        with open(args.seed_devices, 'w', encoding='utf-8') as f:
+            json.dump(devices, f, indent=2)
+        print(f"Wrote {len(devices)} devices to {args.seed_devices}")
+        return
+
+    speed = f"{args.speed:g}x" if args.speed else "max speed"
+    print(f"Replaying {len(records)} requests against {url} at {speed}")
+    results, wall = replay(records, url, args.speed, args.concurrency,
+                           server_config["shared_secret_key"], server_config.get("admin_api_key", ""))
+    report(results, wall, records[-1]["t"] - records[0]["t"])
+
+if __name__ == '__main__':
+    main()
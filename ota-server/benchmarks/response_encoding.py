@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Update-check response encoding benchmark: JSON vs MessagePack vs CBOR
+
+Reports body size and two timings for the "update available" and "no update"
+responses, each like-for-like across formats:
+
+- body: encoding the body alone (json.dumps vs the binary encoders)
+- response: building the Flask response the way check_firmware_update does
+  (jsonify for JSON, Response around the encoded body for binary formats)
+
+The binary formats are timed both uncached and through the per-release cache.
+
+Usage:
+    python benchmarks/response_encoding.py [--iterations 20000]
+"""
+import json
+import timeit
+import argparse
+
+import common  # noqa: F401  Puts the server modules on sys.path
+
+from flask import Response, jsonify
+
+from app import app
+from wire_format import CBOR_MIMETYPE, MSGPACK_MIMETYPE, encode, encode_check_response
+
+PAYLOADS = {
+    "update": {
+        "update_available": True,
+        "firmware_version": "1.3.0",
+        "firmware_url": "https://ota.example.com/firmware/PanicButton_v1.3.0.bin",
+        "checksum": "e10adc3949ba59abbe56e057f20f883e"
+    },
+    "no update": {
+        "update_available": False
+    }
+}
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description='Response encoding benchmark')
+    parser.add_argument('--iterations', type=int, default=20000, help='Encodes per measurement')
+    args = parser.parse_args()
+
+    def time_us(func) -> float:
+        return timeit.timeit(func, number=args.iterations) / args.iterations * 1e6
+
+    print(f"{'Payload':<10} {'Format':<18} {'bytes':>6} {'us/body':>9} {'us/response':>12}")
+    print("-" * 59)
+    with app.app_context():
+        for name, payload in PAYLOADS.items():
+            # (label, body encoder, mimetype; None builds the response with jsonify)
+            cases = [
+                ("json", lambda p=payload: json.dumps(p, separators=(',', ':')).encode('utf-8'), None),
+                ("msgpack", lambda p=payload: encode(p, MSGPACK_MIMETYPE, short_keys=True), MSGPACK_MIMETYPE),
+                ("msgpack (cached)", lambda p=payload: encode_check_response(p, MSGPACK_MIMETYPE), MSGPACK_MIMETYPE),
+                ("cbor", lambda p=payload: encode(p, CBOR_MIMETYPE, short_keys=True), CBOR_MIMETYPE),
+                ("cbor (cached)", lambda p=payload: encode_check_response(p, CBOR_MIMETYPE), CBOR_MIMETYPE),
+            ]
+            for label, body, mimetype in cases:
+                if mimetype is None:
+                    def response(p=payload):
+                        return jsonify(p)
+                else:
+                    def response(body=body, mimetype=mimetype):
+                        return Response(body(), mimetype=mimetype)
+                size = len(response().get_data())
+                print(f"{name:<10} {label:<18} {size:>6} {time_us(body):>9.2f} {time_us(response):>12.2f}")
+
+if __name__ == '__main__':
+    main()
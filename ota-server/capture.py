@@ -0,0 +1,246 @@
+"""
+Request capture for the OTA update server.
+
+When capture_file is set, every request is appended to it as one JSON line
+with its route, parameters, timing and status, for replay with
+benchmarks/replay.py. Secrets are never written: auth headers and device
+tokens are reduced to whether they were valid. With capture_anonymize,
+MAC addresses and device IDs are replaced by keyed pseudonyms that stay
+consistent within a capture, so the traffic shape survives anonymization.
+
+Record fields:
+
+    t  Request start (Unix time)          r  Route rule, None if unmatched
+    m  Method                             p  Path
+    q  Query parameters                   h  Accept / Range headers
+    a  Auth outcome {"device"|"admin": "ok"|"bad"}
+    b  JSON body                          n  Size of a non-JSON body
+    s  Status code                        d  Duration in ms
+    o  Response body size
+"""
+import os
+import re
+import hmac
+import atexit
+import json
+import queue
+import hashlib
+import logging
+import threading
+from typing import Any, Dict, Optional
+
+from utils import generate_auth_token
+
+# MAC addresses written with colons, dashes or no separators; the hex-digit
+# lookarounds keep longer hex strings such as checksums from matching
+MAC_PATTERN = re.compile(
+    r'(?<![0-9A-Fa-f])(?:[0-9A-Fa-f]{2}([:-])[0-9A-Fa-f]{2}(?:\1[0-9A-Fa-f]{2}){4}|[0-9A-Fa-f]{12})(?![0-9A-Fa-f])'
+)
+
+# Fields and route arguments that hold a device's MAC address
+MAC_FIELDS = ("mac", "mac_address")
+
+# Request headers that change how a response is served
+CAPTURED_HEADERS = ("Accept", "Range")
+
+_queue: "queue.SimpleQueue[Optional[str]]" = queue.SimpleQueue()
+_writer_thread: Optional[threading.Thread] = None
+_salt = b""
+_anonymize = True
+
+def is_capturing() -> bool:
+    """Whether requests are being captured"""
+    return _writer_thread is not None
+
+def pseudonymize_mac(mac: str) -> str:
+    """
+    Replace a MAC address with a stable pseudonym
+
+    The pseudonym is a locally administered unicast address, so it can't
+    collide with a real device. It is written in the same notation as the
+    input, and the same address gets the same pseudonym in any notation.
+
+    Args:
+        mac: MAC address, with colons, dashes or no separators
+
+    Returns:
+        Pseudonymous MAC address, or the input unchanged if not anonymizing
+    """
+    if not _anonymize:
+        return mac
+    digits = mac.replace(':', '').replace('-', '').upper()
+    canonical = ':'.join(digits[i:i+2] for i in range(0, 12, 2))
+    digest = bytearray(hmac.new(_salt, canonical.encode('utf-8'), hashlib.sha256).digest()[:6])
+    digest[0] = (digest[0] | 0x02) & 0xFE
+    separator = '-' if '-' in mac else (':' if ':' in mac else '')
+    return separator.join(f"{b:02X}" for b in digest)
+
+def pseudonymize_device_id(device_id: str) -> str:
+    """Replace a device ID with a stable pseudonym"""
+    if not _anonymize:
+        return device_id
+    return "device_" + hmac.new(_salt, device_id.encode('utf-8'), hashlib.sha256).hexdigest()[:12]
+
+def pseudonymize_mac_field(value: str) -> str:
+    """
+    Replace the value of a MAC address field with a stable pseudonym
+
+    A value that isn't a recognizable MAC address is replaced by a token that
+    is still not one, so a rejected request is rejected again on replay.
+    """
+    if not _anonymize or not value:
+        return value
+    if MAC_PATTERN.fullmatch(value):
+        return pseudonymize_mac(value)
+    return "invalid_" + hmac.new(_salt, value.encode('utf-8'), hashlib.sha256).hexdigest()[:12]
+
+def anonymize_value(value: Any, key: Optional[str] = None) -> Any:
+    """
+    Anonymize MAC addresses and device IDs in a request value, recursively
+
+    Args:
+        value: Query parameter or JSON body value
+        key: Field name the value belongs to
+
+    Returns:
+        Anonymized copy of the value
+    """
+    if isinstance(value, dict):
+        return {
+            (MAC_PATTERN.sub(lambda m: pseudonymize_mac(m.group(0)), k) if isinstance(k, str) else k): anonymize_value(v, k)
+            for k, v in value.items()
+        }
+    if isinstance(value, list):
+        return [anonymize_value(item, key) for item in value]
+    if isinstance(value, str):
+        if key == "device_id":
+            return pseudonymize_device_id(value)
+        if key in MAC_FIELDS:
+            return pseudonymize_mac_field(value)
+        return MAC_PATTERN.sub(lambda m: pseudonymize_mac(m.group(0)), value)
+    return value
+
+def _token_outcome(mac: Any, token: Any, secret: str) -> Optional[str]:
+    """Reduce a device token to whether it was valid"""
+    if not token:
+        return None
+    if isinstance(mac, str) and isinstance(token, str) and token.upper() == generate_auth_token(mac.upper(), secret):
+        return "ok"
+    return "bad"
+
+def _scrub_batch(body: Dict[str, Any], secret: str) -> None:
+    """Replace device tokens in a batch check body with their outcome"""
+    for check in body.get("devices") or ():
+        if isinstance(check, dict) and "token" in check:
+            check["token"] = _token_outcome(check.get("mac"), check["token"], secret)
+
+def build_record(request, response, started: float, duration: float, config: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Build the capture record for a request
+
+    Args:
+        request: Flask request
+        response: Flask response
+        started: Request start (Unix time)
+        duration: Time spent handling the request, in seconds
+        config: Server configuration
+
+    Returns:
+        Capture record
+    """
+    path = request.path
+    mac_arg = (request.view_args or {}).get("mac_address")
+    if mac_arg and path.endswith(mac_arg):
+        path = anonymize_value(path[:-len(mac_arg)]) + pseudonymize_mac_field(mac_arg)
+    else:
+        path = anonymize_value(path)
+    record: Dict[str, Any] = {
+        "t": round(started, 3),
+        "m": request.method,
+        "r": request.url_rule.rule if request.url_rule else None,
+        "p": path
+    }
+    if request.args:
+        record["q"] = anonymize_value(request.args.to_dict())
+
+    headers = {name: request.headers[name] for name in CAPTURED_HEADERS if name in request.headers}
+    if headers:
+        record["h"] = headers
+
+    auth = {}
+    if "X-Device-Auth" in request.headers:
+        auth["device"] = _token_outcome(request.args.get("mac"), request.headers["X-Device-Auth"],
+                                        config["shared_secret_key"])
+    if "X-Admin-API-Key" in request.headers:
+        auth["admin"] = "ok" if request.headers["X-Admin-API-Key"] == config.get("admin_api_key") else "bad"
+    if auth:
+        record["a"] = auth
+
+    if request.is_json:
+        body = request.get_json(silent=True)
+        if isinstance(body, dict):
+            _scrub_batch(body, config["shared_secret_key"])
+        if body is not None:
+            record["b"] = anonymize_value(body)
+    elif request.content_length:
+        record["n"] = request.content_length
+
+    record["s"] = response.status_code
+    record["d"] = round(duration * 1000, 3)
+    if response.content_length is not None:
+        record["o"] = response.content_length
+    return record
+
+def capture_request(request, response, started: float, duration: float, config: Dict[str, Any]) -> None:
+    """Queue a request's capture record for writing"""
+    try:
+        record = build_record(request, response, started, duration, config)
+        _queue.put(json.dumps(record, separators=(',', ':')))
+    except Exception as e:  # Capture must never fail a request
+        logging.error("Error capturing request: %s", e)
+
+def _write_loop(path: str) -> None:
+    """Background loop appending queued records to the capture file"""
+    with open(path, 'a', encoding='utf-8') as f:
+        while True:
+            line = _queue.get()
+            if line is None:
+                break
+            f.write(line)
+            f.write("\n")
+            # Flush once the queue has drained rather than per record
+            if _queue.empty():
+                f.flush()
+
+def start_capture(config: Dict[str, Any]) -> None:
+    """
+    Start writing request records to config["capture_file"]
+
+    Args:
+        config: Server configuration
+    """
+    global _writer_thread, _salt, _anonymize
+    if _writer_thread and _writer_thread.is_alive():
+        return
+    _anonymize = config["capture_anonymize"]
+    # Without a configured salt, pseudonyms only stay consistent within this run
+    _salt = config["capture_salt"].encode('utf-8') if config["capture_salt"] else os.urandom(16)
+    path = config["capture_file"]
+    logging.info("Capturing requests to %s (%s)", path, "anonymized" if _anonymize else "not anonymized")
+    _writer_thread = threading.Thread(
+        target=_write_loop,
+        args=(path,),
+        name="request-capture",
+        daemon=True
+    )
+    _writer_thread.start()
+    atexit.register(stop_capture)
+
+def stop_capture() -> None:
+    """Write any queued records and stop capturing"""
+    global _writer_thread
+    if _writer_thread is None:
+        return
+    _queue.put(None)
+    _writer_thread.join()
+    _writer_thread = None
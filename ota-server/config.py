@@ -3,8 +3,20 @@ Configuration management for the OTA update server.
 """
 import os
 import json
+import uuid
 import logging
-from typing import Dict, Any, Optional
+import threading
+from collections import deque
+from contextlib import contextmanager
+from itertools import islice
+from typing import Dict, Any, Callable, Iterable, Iterator, List, Mapping, MutableMapping, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows; locking is then limited to this process
+    fcntl = None
+
+from registry import CompactRegistry
 
 # Default config values
 DEFAULT_CONFIG = {
@@ -13,13 +25,53 @@ DEFAULT_CONFIG = {
     "server_host": "0.0.0.0",
     "debug_mode": False,
     "log_level": "INFO",
-    "devices_file": "devices.json"
+    "devices_file": "devices.json",
+    "compact_registry": False,
+    "firmware_directory": "firmware",
+    "firmware_cache_mb": 64,
+    "firmware_offload": "",
+    "firmware_offload_prefix": "/internal/firmware/",
+    "firmware_keep_versions": 3,
+    "manifest_directory": "",
+    "max_batch_size": 1000,
+    "capture_file": "",
+    "capture_anonymize": True,
+    "capture_salt": "",
+    "mirror_primary_url": "",
+    "mirror_api_key": "",
+    "mirror_sync_interval": 60
 }
 
 # Global config dictionary
 _config: Dict[str, Any] = {}
-# Global devices dictionary
-_devices: Dict[str, Dict[str, Any]] = {}
+# Global devices dictionary (a CompactRegistry when compact_registry is enabled)
+_devices: MutableMapping[str, Dict[str, Any]] = {}
+
+# Devices file (mtime, size) as of the last load or save; "unloaded" until the first load
+_devices_stamp: Any = "unloaded"
+# Set by the SIGHUP handler; the registry is reloaded on next access
+_reload_requested = False
+
+# Exclusive lock on the devices file, shared by the server and admin tools
+_devices_lock = threading.RLock()
+_lock_depth = 0
+_lock_file = None
+# Deferred saves while inside batch_devices()
+_batch_depth = 0
+_batch_dirty = False
+
+# Number of registry changes kept in memory for the change feed
+CHANGE_LOG_SIZE = 10000
+# Longest a change feed request may long-poll, in seconds
+CHANGES_MAX_WAIT = 30
+
+# Change feed state; the epoch changes whenever the server restarts
+_change_epoch = uuid.uuid4().hex
+_change_seq = 0
+_changes: deque = deque(maxlen=CHANGE_LOG_SIZE)
+_changes_cond = threading.Condition()
+# Functions called with each change as it is recorded
+_change_listeners: List[Callable[[Dict[str, Any]], None]] = []
 
 def load_config(config_file: str = "config.json") -> Dict[str, Any]:
     """
@@ -79,21 +131,36 @@ def get_config() -> Dict[str, Any]:
         return load_config()
     return _config
 
-def load_devices() -> Dict[str, Dict[str, Any]]:
+def _new_registry(devices: Dict[str, Dict[str, Any]]) -> MutableMapping[str, Dict[str, Any]]:
+    """Wrap loaded devices in the configured registry representation"""
+    if get_config()["compact_registry"]:
+        return CompactRegistry(devices)
+    return devices
+
+def _file_stamp(path: str) -> Optional[tuple]:
+    """Get a file's (mtime, size), or None if it doesn't exist"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+def load_devices() -> MutableMapping[str, Dict[str, Any]]:
     """
     Load device information from the devices file
     
     Returns:
         Dict of device configurations indexed by MAC address
     """
-    global _devices
+    global _devices, _devices_stamp
     
     config = get_config()
     devices_file = config["devices_file"]
+    _devices_stamp = _file_stamp(devices_file)
     
     if not os.path.exists(devices_file):
         logging.warning("Devices file %s not found", devices_file)
-        _devices = {}
+        _devices = _new_registry({})
         return _devices
     
     try:
@@ -101,20 +168,112 @@ def load_devices() -> Dict[str, Dict[str, Any]]:
             devices = json.load(f)
         
         # Convert all MAC addresses to uppercase for consistency
-        _devices = {mac.upper(): device_info for mac, device_info in devices.items()}
+        _devices = _new_registry({mac.upper(): device_info for mac, device_info in devices.items()})
         
         logging.info("Loaded %d devices from %s", len(_devices), devices_file)
         return _devices
     except Exception as e:
         logging.error("Error loading devices file: %s", e)
-        _devices = {}
+        _devices = _new_registry({})
         return _devices
 
-def get_devices() -> Dict[str, Dict[str, Any]]:
-    """Get the current device configurations"""
-    global _devices
-    if not _devices:
-        return load_devices()
+def reload_devices() -> MutableMapping[str, Dict[str, Any]]:
+    """
+    Reload the devices file, e.g. after it was changed by the admin tools,
+    recording any differences in the change feed
+    
+    Returns:
+        Dict of device configurations indexed by MAC address
+    """
+    with devices_lock():
+        if _devices_stamp == "unloaded":
+            return load_devices()
+        old_devices = _devices
+        devices = load_devices()
+        for mac, device_info in devices.items():
+            old_info = old_devices.get(mac)
+            if old_info is None or dict(old_info) != dict(device_info):
+                record_change("update", mac, device_info)
+        for mac in old_devices:
+            if mac not in devices:
+                record_change("delete", mac)
+        return devices
+
+def request_reload(*_args) -> None:
+    """Reload the devices file on next access; usable as a signal handler"""
+    global _reload_requested
+    _reload_requested = True
+
+def _reload_if_changed() -> None:
+    """Reload the devices file if it changed since it was last loaded or saved"""
+    # Inside a batch the lock is held and the file was checked on entry
+    if _batch_depth:
+        return
+    if _file_stamp(get_config()["devices_file"]) != _devices_stamp:
+        reload_devices()
+
+@contextmanager
+def devices_lock() -> Iterator[None]:
+    """
+    Hold an exclusive lock on the devices file
+    
+    The lock is shared with other processes (e.g. admin_tools.py --direct)
+    through a companion .lock file and is reentrant within this process.
+    """
+    global _lock_depth, _lock_file
+    with _devices_lock:
+        if _lock_depth == 0:
+            _lock_file = open(get_config()["devices_file"] + ".lock", 'a', encoding='utf-8')
+            if fcntl:
+                fcntl.flock(_lock_file, fcntl.LOCK_EX)
+        _lock_depth += 1
+        try:
+            yield
+        finally:
+            _lock_depth -= 1
+            if _lock_depth == 0:
+                # Closing the file releases the flock
+                _lock_file.close()
+                _lock_file = None
+
+@contextmanager
+def batch_devices() -> Iterator[None]:
+    """
+    Apply registry changes in memory and save the devices file once
+    
+    Holds the devices lock for the whole block. If the block raises, its
+    changes are discarded by reloading the devices file.
+    """
+    global _batch_depth, _batch_dirty
+    with devices_lock():
+        _reload_if_changed()
+        _batch_depth += 1
+        try:
+            yield
+        except BaseException:
+            _batch_depth -= 1
+            if _batch_depth == 0:
+                _batch_dirty = False
+                reload_devices()
+            raise
+        _batch_depth -= 1
+        if _batch_depth == 0 and _batch_dirty:
+            _batch_dirty = False
+            save_devices()
+
+def get_devices() -> MutableMapping[str, Dict[str, Any]]:
+    """
+    Get the current device configurations
+    
+    The devices file is reloaded first if it changed on disk (e.g. through
+    admin_tools.py --direct), so a record read here and saved back later
+    can't undo that change.
+    """
+    global _reload_requested
+    if _reload_requested:
+        _reload_requested = False
+        return reload_devices()
+    _reload_if_changed()
     return _devices
 
 def get_device(mac_address: str) -> Optional[Dict[str, Any]]:
@@ -130,6 +289,40 @@ def get_device(mac_address: str) -> Optional[Dict[str, Any]]:
     devices = get_devices()
     return devices.get(mac_address.upper())
 
+def iter_devices_json(items: Iterable[Tuple[str, Mapping[str, Any]]], indent: Optional[int] = 2,
+                      sort_keys: bool = False) -> Iterator[str]:
+    """
+    Serialize device configurations to JSON one record at a time
+    
+    Produces the same output as json.dumps of the equivalent dict, without
+    ever building a dict-of-dicts copy of a compact registry. Plain dict
+    registries are faster to serialize with json.dumps directly.
+    
+    Args:
+        items: (MAC address, device configuration) pairs, e.g. get_devices().items()
+        indent: Indentation as for json.dumps; None for compact output
+        sort_keys: Sort MAC addresses and record fields, as json.dumps does
+        
+    Yields:
+        Chunks of the JSON document
+    """
+    if sort_keys:
+        items = sorted(items, key=lambda item: item[0])
+    if indent is None:
+        separator, item_separator, key_separator, newline = "", ",", ":", ""
+    else:
+        separator, item_separator, key_separator, newline = "\n" + " " * indent, ",", ": ", "\n"
+    first = True
+    for mac, device_info in items:
+        record = json.dumps(dict(device_info), indent=indent, sort_keys=sort_keys,
+                            separators=(item_separator, key_separator))
+        if indent is not None:
+            # Nest the record one level deeper; JSON strings never contain raw newlines
+            record = record.replace("\n", separator)
+        yield ("{" if first else item_separator) + separator + json.dumps(mac) + key_separator + record
+        first = False
+    yield "{}" if first else newline + "}"
+
 def save_devices() -> bool:
     """
     Save the current device configurations to the devices file
@@ -137,13 +330,22 @@ def save_devices() -> bool:
     Returns:
         True if successful, False otherwise
     """
-    global _devices
+    global _devices, _devices_stamp, _batch_dirty
+    if _batch_depth:
+        _batch_dirty = True
+        return True
+        
     config = get_config()
     devices_file = config["devices_file"]
     
     try:
-        with open(devices_file, 'w', encoding='utf-8') as f:
-            json.dump(_devices, f, indent=2)
+        with devices_lock():
+            with open(devices_file, 'w', encoding='utf-8') as f:
+                if isinstance(_devices, CompactRegistry):
+                    f.writelines(iter_devices_json(_devices.items()))
+                else:
+                    json.dump(_devices, f, indent=2)
+            _devices_stamp = _file_stamp(devices_file)
         logging.info("Saved %d devices to %s", len(_devices), devices_file)
         return True
     except Exception as e:
@@ -162,8 +364,35 @@ def update_device(mac_address: str, device_info: Dict[str, Any]) -> bool:
         True if successful, False otherwise
     """
     global _devices
-    _devices[mac_address.upper()] = device_info
-    return save_devices()
+    with devices_lock():
+        _reload_if_changed()
+        _devices[mac_address.upper()] = device_info
+        record_change("update", mac_address, device_info)
+        return save_devices()
+
+def record_device_check(mac_address: str, timestamp: str) -> bool:
+    """
+    Record a device's last check time
+    
+    Only the timestamp goes to the change feed (as a "check" change), so
+    devices polling for updates don't fill the log with copies of records
+    that haven't otherwise changed.
+    
+    Args:
+        mac_address: MAC address of the device (case insensitive)
+        timestamp: ISO timestamp of the check
+        
+    Returns:
+        True if successful, False if the device is unknown or saving failed
+    """
+    with devices_lock():
+        _reload_if_changed()
+        device_info = _devices.get(mac_address.upper())
+        if device_info is None:
+            return False
+        device_info["last_check"] = timestamp
+        record_change("check", mac_address, device_info)
+        return save_devices()
 
 def delete_device(mac_address: str) -> bool:
     """
@@ -177,7 +406,97 @@ def delete_device(mac_address: str) -> bool:
     """
     global _devices
     mac_upper = mac_address.upper()
-    if mac_upper in _devices:
-        del _devices[mac_upper]
-        return save_devices()
-    return False
\ No newline at end of file
+    with devices_lock():
+        _reload_if_changed()
+        if mac_upper in _devices:
+            del _devices[mac_upper]
+            record_change("delete", mac_upper)
+            return save_devices()
+    return False
+
+def record_change(op: str, mac_address: str, device_info: Optional[Dict[str, Any]] = None) -> int:
+    """
+    Append a registry mutation to the change feed and wake any long-pollers
+    
+    Args:
+        op: Type of change ("update", "delete", or "check" when only
+            last_check changed)
+        mac_address: MAC address of the device (case insensitive)
+        device_info: New device configuration for updates and checks; a check
+            change carries only its last_check
+        
+    Returns:
+        Sequence number assigned to the change
+    """
+    global _change_seq
+    with _changes_cond:
+        _change_seq += 1
+        change = {"seq": _change_seq, "op": op, "mac": mac_address.upper()}
+        if op == "check":
+            change["last_check"] = device_info["last_check"]
+        elif device_info is not None:
+            change["device"] = dict(device_info)
+        _changes.append(change)
+        for listener in _change_listeners:
+            try:
+                listener(change)
+            except Exception as e:
+                logging.error("Error in registry change listener: %s", e)
+        _changes_cond.notify_all()
+        return _change_seq
+
+def add_change_listener(listener: Callable[[Dict[str, Any]], None]) -> None:
+    """
+    Call a function with every registry change as it is recorded
+    
+    Listeners run synchronously with the mutation, so they must be quick.
+    
+    Args:
+        listener: Function taking the change dict (seq, op, mac, device)
+    """
+    _change_listeners.append(listener)
+
+def get_change_seq() -> Dict[str, Any]:
+    """Get the current change feed epoch and sequence number"""
+    with _changes_cond:
+        return {"epoch": _change_epoch, "seq": _change_seq}
+
+def get_changes(since: int, wait: float = 0, epoch: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Get registry changes after a sequence number
+    
+    Args:
+        since: Last sequence number the caller has seen
+        wait: Seconds to wait for a new change if there are none yet
+        epoch: Epoch the caller's `since` belongs to; a different epoch means
+            the server restarted and the caller must reload
+        
+    Returns:
+        Dict with the epoch, latest sequence number, changes after `since`, and
+        a reset flag set when the caller has missed changes and must reload
+    """
+    with _changes_cond:
+        if epoch is not None and epoch != _change_epoch:
+            # Sequence numbers from another epoch say nothing about this log
+            return {
+                "epoch": _change_epoch,
+                "seq": _change_seq,
+                "reset": True,
+                "changes": []
+            }
+            
+        if wait > 0 and since == _change_seq:
+            _changes_cond.wait_for(lambda: _change_seq > since, wait)
+            
+        # Sequence numbers in the log are contiguous, so index by offset
+        oldest = _changes[0]["seq"] if _changes else _change_seq + 1
+        reset = since < oldest - 1 or since > _change_seq
+        start = max(since - oldest + 1, 0)
+        changes = [] if since > _change_seq else list(islice(_changes, start, None))
+        
+        return {
+            "epoch": _change_epoch,
+            "seq": _change_seq,
+            "reset": reset,
+            "changes": changes
+        }
\ No newline at end of file
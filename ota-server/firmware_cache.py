@@ -0,0 +1,105 @@
+"""
+In-memory cache of hot firmware images for the OTA update server.
+
+During a rollout nearly every download is for the same one or two binaries.
+Files requested repeatedly are kept in a bounded LRU cache and served from
+memory; an entry is dropped as soon as its file's mtime or size changes.
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional
+
+# Requests for a file before it is considered hot and loaded into memory
+HOT_THRESHOLD = 2
+
+class CachedFirmware(NamedTuple):
+    """A firmware image held in memory"""
+    mtime_ns: int
+    size: int
+    data: bytes
+
+_cache: "OrderedDict[str, CachedFirmware]" = OrderedDict()
+_cache_bytes = 0
+# Requests seen for files that are not cached yet
+_miss_counts: Dict[str, int] = {}
+_cache_lock = threading.Lock()
+
+def _evict(path: str) -> None:
+    """Remove an entry from the cache; caller must hold the lock"""
+    global _cache_bytes
+    entry = _cache.pop(path, None)
+    if entry:
+        _cache_bytes -= entry.size
+
+def get_firmware(path: str, stat: os.stat_result, max_bytes: int) -> Optional[CachedFirmware]:
+    """
+    Get a firmware image from the cache, loading it once it has become hot
+
+    Args:
+        path: Path to the firmware file
+        stat: Current stat of the file, used to detect changes
+        max_bytes: Cache size limit in bytes (0 disables the cache)
+
+    Returns:
+        Cached image, or None if the file should be served from disk
+    """
+    global _cache_bytes
+    if max_bytes <= 0 or stat.st_size > max_bytes:
+        return None
+
+    with _cache_lock:
+        entry = _cache.get(path)
+        if entry and entry.mtime_ns == stat.st_mtime_ns and entry.size == stat.st_size:
+            _cache.move_to_end(path)
+            return entry
+        _evict(path)
+
+        count = _miss_counts.get(path, 0) + 1
+        if count < HOT_THRESHOLD:
+            _miss_counts[path] = count
+            return None
+        _miss_counts.pop(path, None)
+
+    # Read outside the lock so other downloads are not blocked
+    with open(path, 'rb') as f:
+        file_stat = os.fstat(f.fileno())
+        data = f.read()
+    if len(data) != file_stat.st_size:
+        # File changed while it was being read
+        return None
+    entry = CachedFirmware(file_stat.st_mtime_ns, len(data), data)
+
+    with _cache_lock:
+        _evict(path)
+        _cache[path] = entry
+        _cache_bytes += entry.size
+        while _cache_bytes > max_bytes:
+            _evict(next(iter(_cache)))
+    return entry
+
+def firmware_etag(stat: os.stat_result) -> str:
+    """
+    ETag for a firmware file, the same whether it is served from cache or disk
+
+    Args:
+        stat: Current stat of the file
+
+    Returns:
+        ETag value derived from the file's modification time and size
+    """
+    return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+def invalidate_firmware(path: str) -> None:
+    """Drop a firmware file from the cache, e.g. after it has been replaced"""
+    with _cache_lock:
+        _evict(path)
+        _miss_counts.pop(path, None)
+
+def clear_firmware_cache() -> None:
+    """Drop all cached firmware images"""
+    global _cache_bytes
+    with _cache_lock:
+        _cache.clear()
+        _miss_counts.clear()
+        _cache_bytes = 0
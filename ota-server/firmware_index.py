@@ -0,0 +1,290 @@
+"""
+Firmware reference index and retention for the OTA update server.
+
+Tracks, for every firmware file, the devices and releases that point at it.
+The index is updated from each registry change as it is recorded, so garbage
+collection never has to scan device records. Release metadata (version and
+hardware) learned for each file is kept in the firmware directory, so old
+files can still be grouped once no device refers to them.
+"""
+import os
+import re
+import json
+import logging
+import tempfile
+import threading
+from functools import cmp_to_key
+from typing import Any, Dict, List, Optional, Set, Tuple
+from urllib.parse import urlparse
+
+from config import get_config, get_devices, devices_lock, add_change_listener
+from firmware_cache import invalidate_firmware
+from utils import compare_versions, validate_version
+
+# Release metadata file, kept in the firmware directory
+INDEX_FILENAME = ".index.json"
+
+# A "v"-prefixed full x.y.z version, as in PanicButton_esp32s3_v1.2.0.bin
+_VERSION_PATTERN = re.compile(r'(?:^|[^0-9A-Za-z])v(\d+\.\d+\.\d+)(?![\d.])')
+
+# MACs referencing each firmware file
+_file_devices: Dict[str, Set[str]] = {}
+# Device count per (hardware, version) release, for each firmware file
+_file_releases: Dict[str, Dict[Tuple[str, str], int]] = {}
+# (filename, hardware, version) referenced by each MAC
+_device_refs: Dict[str, Tuple[str, str, str]] = {}
+# Release metadata per firmware file: {"version": str, "hardware": [str]}
+_metadata: Dict[str, Dict[str, Any]] = {}
+_metadata_dirty = False
+_index_ready = False
+_index_lock = threading.RLock()
+
+def firmware_filename(firmware_url: Optional[str]) -> Optional[str]:
+    """
+    Get the firmware file a URL points at
+
+    Any URL whose path is /firmware/<filename> counts, whatever its host, so
+    files served by mirrors are protected too.
+
+    Args:
+        firmware_url: Firmware URL from a device record
+
+    Returns:
+        Filename, or None if the URL doesn't point at a served firmware file
+    """
+    if not firmware_url:
+        return None
+    path = urlparse(firmware_url).path
+    if not path.startswith('/firmware/'):
+        return None
+    return os.path.basename(path) or None
+
+def _version_from_filename(filename: str) -> Optional[str]:
+    """Get the version from a filename such as PanicButton_v1.2.1.bin, or None if it has none"""
+    match = _VERSION_PATTERN.search(os.path.splitext(filename)[0])
+    return match.group(1) if match else None
+
+def _index_path() -> str:
+    """Path of the release metadata file"""
+    return os.path.join(get_config().get("firmware_directory", "firmware"), INDEX_FILENAME)
+
+def _load_metadata() -> None:
+    """Load release metadata from the firmware directory"""
+    global _metadata
+    path = _index_path()
+    if not os.path.exists(path):
+        _metadata = {}
+        return
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            _metadata = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.error("Error loading firmware index %s: %s", path, e)
+        _metadata = {}
+
+def _save_metadata() -> None:
+    """Write release metadata to the firmware directory if it changed"""
+    global _metadata_dirty
+    if not _metadata_dirty:
+        return
+    path = _index_path()
+    directory = os.path.dirname(path) or "."
+    if not os.path.isdir(directory):
+        return
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".index.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(_metadata, f, indent=2)
+        os.replace(temp_path, path)
+        _metadata_dirty = False
+    except OSError as e:
+        logging.error("Error saving firmware index %s: %s", path, e)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def _learn_release(filename: str, version: Optional[str], hardware: Optional[str]) -> None:
+    """Record which release a firmware file belongs to"""
+    global _metadata_dirty
+    if not version or not validate_version(version):
+        return
+    meta = _metadata.get(filename)
+    if meta is None:
+        meta = _metadata[filename] = {"version": version, "hardware": []}
+        _metadata_dirty = True
+    if hardware and hardware not in meta["hardware"]:
+        meta["hardware"].append(hardware)
+        _metadata_dirty = True
+
+def _add_ref(mac: str, device_info: Dict[str, Any]) -> None:
+    """Index a device's reference to its firmware file"""
+    filename = firmware_filename(device_info.get("firmware_url"))
+    if not filename:
+        return
+    hardware = device_info.get("hardware_version") or "unknown"
+    version = device_info.get("target_version") or ""
+    _device_refs[mac] = (filename, hardware, version)
+    _file_devices.setdefault(filename, set()).add(mac)
+    releases = _file_releases.setdefault(filename, {})
+    releases[(hardware, version)] = releases.get((hardware, version), 0) + 1
+    _learn_release(filename, version, hardware)
+
+def _remove_ref(mac: str) -> None:
+    """Drop a device's reference from the index"""
+    ref = _device_refs.pop(mac, None)
+    if not ref:
+        return
+    filename, hardware, version = ref
+    devices = _file_devices.get(filename)
+    if devices:
+        devices.discard(mac)
+        if not devices:
+            del _file_devices[filename]
+    releases = _file_releases.get(filename)
+    if releases:
+        releases[(hardware, version)] -= 1
+        if releases[(hardware, version)] <= 0:
+            del releases[(hardware, version)]
+        if not releases:
+            del _file_releases[filename]
+
+def _on_change(change: Dict[str, Any]) -> None:
+    """Registry change listener keeping the index current"""
+    if not _index_ready or change["op"] == "check":
+        return
+    with _index_lock:
+        _remove_ref(change["mac"])
+        if change["op"] == "update":
+            _add_ref(change["mac"], change["device"])
+        _save_metadata()
+
+add_change_listener(_on_change)
+
+def ensure_index() -> None:
+    """Build the index from the registry if it hasn't been built yet"""
+    global _index_ready
+    if _index_ready:
+        return
+    # Hold the devices lock so no change slips in while building
+    with devices_lock():
+        with _index_lock:
+            if _index_ready:
+                return
+            _file_devices.clear()
+            _file_releases.clear()
+            _device_refs.clear()
+            _load_metadata()
+            for mac, device_info in get_devices().items():
+                _add_ref(mac.upper(), device_info)
+            _save_metadata()
+            _index_ready = True
+    logging.info("Built firmware index: %d files referenced by %d devices",
+                 len(_file_devices), len(_device_refs))
+
+def record_firmware(filename: str, version: Optional[str], hardware: Optional[str]) -> None:
+    """
+    Record the release a newly stored firmware file belongs to
+
+    Args:
+        filename: Firmware filename
+        version: Firmware version
+        hardware: Hardware version it is built for
+    """
+    ensure_index()
+    with _index_lock:
+        _learn_release(filename, version, hardware)
+        _save_metadata()
+
+def file_references(filename: str) -> Dict[str, Any]:
+    """
+    Get the devices and releases using a firmware file
+
+    Args:
+        filename: Firmware filename
+
+    Returns:
+        Dict with the device count and a list of {hardware, version, devices}
+    """
+    ensure_index()
+    with _index_lock:
+        releases = _file_releases.get(filename, {})
+        return {
+            "devices": len(_file_devices.get(filename, ())),
+            "releases": [{"hardware": hardware, "version": version, "devices": count}
+                         for (hardware, version), count in sorted(releases.items())]
+        }
+
+def collect_garbage(keep: int, dry_run: bool = False) -> Dict[str, Any]:
+    """
+    Delete firmware files outside the retention policy
+
+    For each hardware version the newest `keep` firmware versions are kept,
+    plus every file a device still points at. Files whose version can't be
+    determined are never deleted.
+
+    Args:
+        keep: Number of versions to keep per hardware version
+        dry_run: Report what would be deleted without deleting anything
+
+    Returns:
+        Dict with deleted, kept, referenced and unknown-version files and bytes freed
+    """
+    global _metadata_dirty
+    ensure_index()
+    firmware_dir = get_config().get("firmware_directory", "firmware")
+
+    # Hold the devices lock so no device can be pointed at a file while it is deleted
+    with devices_lock(), _index_lock:
+        sizes: Dict[str, int] = {}
+        if os.path.isdir(firmware_dir):
+            for entry in os.scandir(firmware_dir):
+                if not entry.name.startswith('.') and entry.is_file():
+                    sizes[entry.name] = entry.stat().st_size
+
+        # Group files by hardware version
+        groups: Dict[str, List[Tuple[str, str]]] = {}
+        unknown = []
+        for filename in sizes:
+            meta = _metadata.get(filename) or {"version": _version_from_filename(filename), "hardware": []}
+            version = meta.get("version")
+            if not version or not validate_version(version):
+                unknown.append(filename)
+                continue
+            for hardware in meta["hardware"] or ["unknown"]:
+                groups.setdefault(hardware, []).append((version, filename))
+
+        retained: Set[str] = set(unknown)
+        for entries in groups.values():
+            versions = sorted({version for version, _ in entries}, key=cmp_to_key(compare_versions), reverse=True)
+            newest = set(versions[:keep])
+            retained.update(filename for version, filename in entries if version in newest)
+
+        referenced = {filename: len(_file_devices[filename]) for filename in sizes if filename in _file_devices}
+        deleted = sorted(filename for filename in sizes if filename not in retained and filename not in referenced)
+
+        if not dry_run:
+            for filename in deleted:
+                path = os.path.join(firmware_dir, filename)
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    logging.error("Error deleting firmware %s: %s", filename, e)
+                    continue
+                invalidate_firmware(path)
+                logging.info("Deleted firmware %s (%d bytes)", filename, sizes[filename])
+            # Forget metadata for files that are gone and no longer referenced
+            for filename in list(_metadata):
+                if filename not in _file_devices and (filename in deleted or filename not in sizes):
+                    del _metadata[filename]
+                    _metadata_dirty = True
+            _save_metadata()
+
+        return {
+            "dry_run": dry_run,
+            "keep": keep,
+            "deleted": deleted,
+            "bytes_freed": sum(sizes[filename] for filename in deleted),
+            "kept": sorted(filename for filename in sizes if filename not in deleted),
+            "referenced": referenced,
+            "unknown_version": sorted(unknown)
+        }
@@ -0,0 +1,229 @@
+"""
+Static update-manifest export for the OTA update server.
+
+The answer to an update check depends only on the device's target release
+and its reported version, so it can be precomputed. When manifest_directory
+is set, the server writes:
+
+    devices/<MAC>/<version>.json  - no-update response, for each spelling of
+                                    the target version ("1.2", "1.2.0")
+    releases/<release_id>.json    - update response for each release
+
+There is deliberately no per-device "update available" file: a reported
+version without a file may be older, newer or spelled differently, so those
+polls go to the app, which authenticates the device before handing out a
+firmware URL.
+
+Files are written atomically and incrementally: the exporter follows the
+registry change feed and only rewrites devices whose target release changed.
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+from typing import Any, Dict, List, Optional, Set
+
+from config import get_config, get_devices, get_change_seq, get_changes, devices_lock, CHANGES_MAX_WAIT
+from utils import validate_version
+
+# Response when the device already runs its target version (or newer)
+NO_UPDATE = {"update_available": False}
+
+# Release id last exported for each device, indexed by MAC address
+_exported: Dict[str, str] = {}
+# Release ids whose release file has been written
+_written_releases: Set[str] = set()
+_export_thread: Optional[threading.Thread] = None
+
+def update_payload(device_info: Dict[str, Any], firmware_url: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Build the update check response for a device that needs an update
+
+    Args:
+        device_info: Device configuration
+        firmware_url: Override for the device's firmware URL
+
+    Returns:
+        Response data as returned by check_firmware_update
+    """
+    return {
+        "update_available": True,
+        "firmware_version": device_info["target_version"],
+        "firmware_url": firmware_url or device_info["firmware_url"],
+        "checksum": device_info["checksum"]
+    }
+
+def version_spellings(version: str) -> List[str]:
+    """
+    List the spellings of a version that compare equal to it
+
+    Args:
+        version: Valid version string, e.g. "1.2.0"
+
+    Returns:
+        The version as given plus its canonical forms with trailing zero
+        components dropped or added, e.g. ["1.2.0", "1.2"]
+    """
+    parts = [int(part) for part in version.split('.')]
+    parts += [0] * (3 - len(parts))
+    spellings = [version]
+    for length in range(1, 4):
+        if not any(parts[length:]):
+            spelling = '.'.join(str(part) for part in parts[:length])
+            if spelling not in spellings:
+                spellings.append(spelling)
+    return spellings
+
+def release_id(device_info: Dict[str, Any]) -> str:
+    """Identify a device's target release by its version, URL and checksum"""
+    digest = hashlib.md5(
+        f"{device_info['firmware_url']}\n{device_info['checksum']}".encode('utf-8')
+    ).hexdigest()[:12]
+    return f"{device_info['target_version']}-{digest}"
+
+def _write_json_atomic(path: str, data: Dict[str, Any]) -> None:
+    """Write a JSON file via a temporary file and rename"""
+    directory = os.path.dirname(path)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def export_device(manifest_dir: str, mac_address: str, device_info: Dict[str, Any]) -> bool:
+    """
+    Write a device's manifest files if its target release changed
+
+    Args:
+        manifest_dir: Root of the manifest tree
+        mac_address: MAC address of the device
+        device_info: Device configuration
+
+    Returns:
+        True if files were written, False if they were already current
+    """
+    mac_upper = mac_address.upper()
+    try:
+        release = release_id(device_info)
+        payload = update_payload(device_info)
+    except KeyError:
+        logging.warning("Not exporting manifest for %s: incomplete device record", mac_upper)
+        return False
+    if not validate_version(payload["firmware_version"]):
+        logging.warning("Not exporting manifest for %s: invalid target version", mac_upper)
+        return False
+    if _exported.get(mac_upper) == release:
+        return False
+
+    if release not in _written_releases:
+        releases_dir = os.path.join(manifest_dir, "releases")
+        os.makedirs(releases_dir, exist_ok=True)
+        _write_json_atomic(os.path.join(releases_dir, f"{release}.json"), payload)
+        _written_releases.add(release)
+
+    device_dir = os.path.join(manifest_dir, "devices", mac_upper)
+    os.makedirs(device_dir, exist_ok=True)
+    current_files = {f"{spelling}.json" for spelling in version_spellings(payload["firmware_version"])}
+    for name in current_files:
+        _write_json_atomic(os.path.join(device_dir, name), NO_UPDATE)
+
+    # Drop the no-update files for the previous target version
+    for name in os.listdir(device_dir):
+        if name not in current_files and not name.startswith('.'):
+            os.remove(os.path.join(device_dir, name))
+
+    _exported[mac_upper] = release
+    return True
+
+def remove_device(manifest_dir: str, mac_address: str) -> None:
+    """Remove a deleted device's manifest files"""
+    mac_upper = mac_address.upper()
+    _exported.pop(mac_upper, None)
+    shutil.rmtree(os.path.join(manifest_dir, "devices", mac_upper), ignore_errors=True)
+
+def export_all(manifest_dir: str) -> int:
+    """
+    Export every device and prune files for devices and releases no longer in use
+
+    Args:
+        manifest_dir: Root of the manifest tree
+
+    Returns:
+        Change feed sequence number the export is current as of
+    """
+    _exported.clear()
+    _written_releases.clear()
+
+    # Read the sequence first; changes after it are replayed by the export loop
+    with devices_lock():
+        seq = get_change_seq()["seq"]
+        devices = list(get_devices().items())
+
+    written = sum(1 for mac, device_info in devices if export_device(manifest_dir, mac, device_info))
+
+    devices_dir = os.path.join(manifest_dir, "devices")
+    known = {mac.upper() for mac, _ in devices}
+    if os.path.isdir(devices_dir):
+        for name in os.listdir(devices_dir):
+            if name not in known:
+                remove_device(manifest_dir, name)
+
+    releases_dir = os.path.join(manifest_dir, "releases")
+    in_use = set(_exported.values())
+    if os.path.isdir(releases_dir):
+        for name in os.listdir(releases_dir):
+            if name.endswith(".json") and name[:-5] not in in_use:
+                os.remove(os.path.join(releases_dir, name))
+
+    logging.info("Exported update manifests: %d of %d devices written", written, len(devices))
+    return seq
+
+def _export_loop(manifest_dir: str) -> None:
+    """Background loop that keeps the manifest tree in step with the change feed"""
+    seq = None
+    while True:
+        try:
+            if seq is None:
+                seq = export_all(manifest_dir)
+            feed = get_changes(seq, CHANGES_MAX_WAIT)
+            if feed["reset"]:
+                seq = None
+                continue
+            for change in feed["changes"]:
+                if change["op"] == "delete":
+                    remove_device(manifest_dir, change["mac"])
+                elif change["op"] == "update":
+                    export_device(manifest_dir, change["mac"], change["device"])
+            seq = feed["seq"]
+        except OSError as e:
+            logging.error("Error exporting update manifests: %s", e)
+            # Start over with a full export once the problem clears
+            seq = None
+            time.sleep(CHANGES_MAX_WAIT)
+        except Exception:  # Keep the thread alive; a dead export loop would serve stale manifests silently
+            logging.exception("Unexpected error exporting update manifests")
+            seq = None
+            time.sleep(CHANGES_MAX_WAIT)
+
+def start_manifest_export() -> None:
+    """Start the background manifest export thread if not already running"""
+    global _export_thread
+    if _export_thread and _export_thread.is_alive():
+        return
+    manifest_dir = get_config()["manifest_directory"]
+    logging.info("Exporting static update manifests to %s", manifest_dir)
+    _export_thread = threading.Thread(
+        target=_export_loop,
+        args=(manifest_dir,),
+        name="manifest-export",
+        daemon=True
+    )
+    _export_thread.start()
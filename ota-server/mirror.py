@@ -0,0 +1,333 @@
+"""
+Edge mirror support for the OTA update server.
+
+A mirror keeps a local copy of the device registry and firmware directory
+in sync with a primary server, answers device requests locally and forwards
+last_check timestamps back to the primary in batches.
+"""
+import os
+import json
+import time
+import logging
+import hashlib
+import tempfile
+import threading
+from typing import Dict, Any, Optional
+from urllib.parse import urlparse
+
+import requests
+
+from config import get_config, get_devices, save_devices, record_change, batch_devices
+from utils import calculate_file_md5, stream_to_file
+
+# Fields owned by whichever server handled the check; not part of a record's digest
+VOLATILE_FIELDS = ("last_check",)
+
+# Cache of firmware MD5s keyed by filename: (mtime_ns, size, md5)
+_firmware_md5_cache: Dict[str, tuple] = {}
+# last_check timestamps waiting to be forwarded to the primary
+_pending_checks: Dict[str, str] = {}
+_pending_lock = threading.Lock()
+# Position in the primary's change feed the local registry is current with
+_feed_epoch: Optional[str] = None
+_feed_seq: Optional[int] = None
+_sync_thread: Optional[threading.Thread] = None
+
+# --- Primary side ---
+
+def device_digest(device_info: Dict[str, Any]) -> str:
+    """
+    Compute a digest of a device record, ignoring volatile fields
+
+    Args:
+        device_info: Device configuration
+
+    Returns:
+        MD5 hex digest of the record's stable fields
+    """
+    stable = {k: v for k, v in device_info.items() if k not in VOLATILE_FIELDS}
+    return hashlib.md5(json.dumps(stable, sort_keys=True).encode('utf-8')).hexdigest()
+
+def registry_manifest() -> Dict[str, str]:
+    """Get the digest of every device record, indexed by MAC address"""
+    return {mac: device_digest(info) for mac, info in get_devices().items()}
+
+def firmware_manifest(firmware_dir: str) -> Dict[str, str]:
+    """
+    Get the MD5 checksum of every firmware file in a directory
+
+    Checksums are cached by modification time and size, so files are only
+    re-hashed when they change.
+
+    Args:
+        firmware_dir: Path to the firmware directory
+
+    Returns:
+        Dict of MD5 checksums indexed by filename
+    """
+    manifest = {}
+    if not os.path.isdir(firmware_dir):
+        return manifest
+
+    for entry in os.scandir(firmware_dir):
+        # Skip in-progress uploads and anything that isn't a regular file
+        if entry.name.startswith('.') or not entry.is_file():
+            continue
+        stat = entry.stat()
+        cached = _firmware_md5_cache.get(entry.name)
+        if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            manifest[entry.name] = cached[2]
+            continue
+        md5 = calculate_file_md5(entry.path)
+        _firmware_md5_cache[entry.name] = (stat.st_mtime_ns, stat.st_size, md5)
+        manifest[entry.name] = md5
+    return manifest
+
+def apply_checks(checks: Dict[str, str]) -> int:
+    """
+    Apply last_check timestamps forwarded by a mirror, saving once
+
+    Args:
+        checks: ISO timestamps indexed by MAC address
+
+    Returns:
+        Number of devices updated
+    """
+    updated = 0
+    with batch_devices():
+        devices = get_devices()
+        for mac, timestamp in checks.items():
+            device_info = devices.get(mac.upper())
+            if not device_info or not isinstance(timestamp, str) or not timestamp:
+                continue
+            # ISO timestamps sort lexically; never move last_check backwards
+            if (device_info.get("last_check") or "") < timestamp:
+                device_info["last_check"] = timestamp
+                record_change("check", mac, device_info)
+                updated += 1
+        if updated:
+            save_devices()
+    return updated
+
+# --- Mirror side ---
+
+def is_mirror() -> bool:
+    """Check if the server is running as a mirror of a primary"""
+    return bool(get_config().get("mirror_primary_url"))
+
+def record_check(mac_address: str, timestamp: str) -> None:
+    """Queue a device's last_check timestamp for forwarding to the primary"""
+    with _pending_lock:
+        _pending_checks[mac_address.upper()] = timestamp
+
+def local_firmware_url(firmware_url: str, host_url: str) -> str:
+    """
+    Point a firmware URL at this mirror if the file is available locally
+
+    Args:
+        firmware_url: URL from the device record (usually on the primary)
+        host_url: Base URL of this server, ending in a slash
+
+    Returns:
+        Local firmware URL, or the original URL if the file isn't mirrored
+    """
+    path = urlparse(firmware_url).path
+    if not path.startswith('/firmware/'):
+        return firmware_url
+    filename = os.path.basename(path)
+    firmware_dir = get_config().get("firmware_directory", "firmware")
+    if not os.path.isfile(os.path.join(firmware_dir, filename)):
+        return firmware_url
+    return f"{host_url}firmware/{filename}"
+
+def _primary_request(method: str, endpoint: str, **kwargs) -> requests.Response:
+    """Make an authenticated request to the primary server"""
+    config = get_config()
+    primary_url = config["mirror_primary_url"].rstrip('/')
+    headers = kwargs.pop("headers", {})
+    headers["X-Admin-API-Key"] = config.get("mirror_api_key") or config.get("admin_api_key", "")
+    response = requests.request(method, f"{primary_url}{endpoint}", headers=headers, timeout=30, **kwargs)
+    response.raise_for_status()
+    return response
+
+def forward_checks() -> int:
+    """
+    Forward queued last_check timestamps to the primary in one request
+
+    Returns:
+        Number of timestamps forwarded
+    """
+    global _pending_checks
+    with _pending_lock:
+        batch, _pending_checks = _pending_checks, {}
+    if not batch:
+        return 0
+
+    try:
+        _primary_request("POST", "/admin/sync/checks", json={"checks": batch})
+    except requests.exceptions.RequestException:
+        # Requeue anything that hasn't been superseded by a newer check
+        with _pending_lock:
+            for mac, timestamp in batch.items():
+                _pending_checks.setdefault(mac, timestamp)
+        raise
+    return len(batch)
+
+def _download_firmware(filename: str, checksum: str, firmware_dir: str) -> None:
+    """Download a firmware file from the primary, verifying its checksum"""
+    response = _primary_request("GET", f"/firmware/{filename}", stream=True)
+    fd, temp_path = tempfile.mkstemp(dir=firmware_dir, prefix=f".{filename}.", suffix=".part")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            digests = stream_to_file(response.raw, f)
+        if digests["md5"] != checksum:
+            raise ValueError(f"checksum mismatch for {filename}: {digests['md5']} != {checksum}")
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, os.path.join(firmware_dir, filename))
+    finally:
+        response.close()
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def _apply_records(records: Dict[str, Dict[str, Any]], removed) -> None:
+    """Store device records from the primary and drop removed devices, saving once"""
+    with batch_devices():
+        devices = get_devices()
+        for mac, device_info in records.items():
+            # Keep whichever last_check is newer
+            local_check = (devices.get(mac) or {}).get("last_check")
+            if local_check and local_check > (device_info.get("last_check") or ""):
+                device_info["last_check"] = local_check
+            devices[mac] = device_info
+            record_change("update", mac, device_info)
+        for mac in removed:
+            if mac in devices:
+                del devices[mac]
+                record_change("delete", mac)
+        if records or removed:
+            save_devices()
+
+def _full_sync(stats: Dict[str, int]) -> Dict[str, str]:
+    """
+    Compare the whole registry with the primary's manifest
+
+    Only device records whose digest differs are fetched. Afterwards the
+    mirror follows the change feed from the manifest's position.
+
+    Returns:
+        Primary's firmware manifest
+    """
+    global _feed_epoch, _feed_seq
+    manifest = _primary_request("GET", "/admin/sync/manifest").json()
+
+    devices = get_devices()
+    remote = manifest.get("devices", {})
+    changed = [mac for mac, digest in remote.items()
+               if mac not in devices or device_digest(devices[mac]) != digest]
+    removed = [mac for mac in devices if mac not in remote]
+
+    records = {}
+    if changed:
+        records = _primary_request("POST", "/admin/sync/devices", json={"macs": changed}).json()
+    _apply_records(records, removed)
+    stats["devices"] = len(changed)
+    stats["removed"] = len(removed)
+    _feed_epoch, _feed_seq = manifest["epoch"], manifest["seq"]
+    return manifest.get("firmware", {})
+
+def _follow_changes(stats: Dict[str, int]) -> Optional[Dict[str, str]]:
+    """
+    Apply the primary's registry changes since the last sync
+
+    Returns:
+        Primary's firmware manifest, or None if the feed was reset and a full
+        sync is needed
+    """
+    global _feed_epoch, _feed_seq
+    feed = _primary_request("GET", "/admin/changes",
+                            params={"since": _feed_seq, "epoch": _feed_epoch}).json()
+    if feed["reset"]:
+        logging.info("Primary change feed reset; running a full mirror sync")
+        return None
+
+    # Only the latest change per device matters; last_check-only changes are
+    # skipped, since each server keeps the timestamps of the checks it answers
+    records = {}
+    removed = set()
+    for change in feed["changes"]:
+        if change["op"] == "delete":
+            records.pop(change["mac"], None)
+            removed.add(change["mac"])
+        elif change["op"] == "update":
+            records[change["mac"]] = change["device"]
+            removed.discard(change["mac"])
+    _apply_records(records, removed)
+    stats["devices"] = len(records)
+    stats["removed"] = len(removed)
+    _feed_epoch, _feed_seq = feed["epoch"], feed["seq"]
+    return _primary_request("GET", "/admin/sync/firmware").json()
+
+def sync_once() -> Dict[str, int]:
+    """
+    Synchronize the registry and firmware directory from the primary
+
+    The first sync compares digests of the whole registry; later syncs only
+    apply the primary's change feed, falling back to a full comparison when
+    the feed resets (the primary restarted or changes were missed). Only
+    firmware binaries whose checksum differs are downloaded.
+
+    Returns:
+        Dict with counts of forwarded checks, changed/removed devices and downloaded files
+    """
+    stats = {"checks": forward_checks(), "devices": 0, "removed": 0, "firmware": 0}
+
+    remote_firmware = None
+    if _feed_seq is not None:
+        remote_firmware = _follow_changes(stats)
+    if remote_firmware is None:
+        remote_firmware = _full_sync(stats)
+
+    # Firmware binaries
+    firmware_dir = get_config().get("firmware_directory", "firmware")
+    if not os.path.exists(firmware_dir):
+        os.makedirs(firmware_dir)
+    local = firmware_manifest(firmware_dir)
+    for filename, checksum in remote_firmware.items():
+        if local.get(filename) == checksum:
+            continue
+        try:
+            _download_firmware(filename, checksum, firmware_dir)
+            stats["firmware"] += 1
+        except (requests.exceptions.RequestException, ValueError, OSError) as e:
+            logging.error("Error mirroring firmware %s: %s", filename, e)
+
+    return stats
+
+def _sync_loop(interval: int) -> None:
+    """Background loop that keeps the mirror in sync"""
+    while True:
+        try:
+            stats = sync_once()
+            if any(stats.values()):
+                logging.info("Mirror sync: forwarded %d checks, %d devices changed, %d removed, %d firmware files",
+                             stats["checks"], stats["devices"], stats["removed"], stats["firmware"])
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logging.error("Mirror sync with primary failed: %s", e)
+        except Exception:  # Keep the thread alive; a dead sync loop would serve stale data silently
+            logging.exception("Unexpected error during mirror sync")
+        time.sleep(interval)
+
+def start_mirror_sync() -> None:
+    """Start the background mirror sync thread if not already running"""
+    global _sync_thread
+    if _sync_thread and _sync_thread.is_alive():
+        return
+    config = get_config()
+    logging.info("Running as mirror of %s", config["mirror_primary_url"])
+    _sync_thread = threading.Thread(
+        target=_sync_loop,
+        args=(config["mirror_sync_interval"],),
+        name="mirror-sync",
+        daemon=True
+    )
+    _sync_thread.start()
@@ -0,0 +1,157 @@
+"""
+Memory-compact device registry for the OTA update server.
+
+Devices are stored as slotted records keyed by 48-bit integer MAC addresses,
+with values shared across many devices (versions, URLs, checksums) interned.
+Both the registry and its records behave like the plain dicts they replace
+and serialize to the same JSON shape.
+"""
+import sys
+import string
+from collections.abc import MutableMapping
+from typing import Any, Dict, Iterator, Mapping, Optional
+
+# Fields stored in slots; anything else goes in a per-record overflow dict
+DEVICE_FIELDS = (
+    "device_id",
+    "hardware_version",
+    "target_version",
+    "firmware_url",
+    "checksum",
+    "last_check",
+    "last_update"
+)
+_FIELD_SET = frozenset(DEVICE_FIELDS)
+
+# Fields whose values are typically shared by many devices
+SHARED_FIELDS = frozenset(("hardware_version", "target_version", "firmware_url", "checksum"))
+
+_HEX_DIGITS = frozenset(string.hexdigits)
+
+# Marks a field that is absent, as opposed to present with a None value
+_MISSING = object()
+
+def mac_to_int(mac: str) -> Optional[int]:
+    """
+    Convert a MAC address to a 48-bit integer
+
+    Args:
+        mac: MAC address, with or without colons
+
+    Returns:
+        Integer value, or None if the MAC address is invalid
+    """
+    mac_clean = mac.replace(":", "")
+    if len(mac_clean) != 12 or not _HEX_DIGITS.issuperset(mac_clean):
+        return None
+    return int(mac_clean, 16)
+
+def int_to_mac(value: int) -> str:
+    """Format a 48-bit integer as a MAC address (AA:BB:CC:DD:EE:FF)"""
+    mac_hex = format(value, '012X')
+    return ':'.join(mac_hex[i:i+2] for i in range(0, 12, 2))
+
+class DeviceRecord(MutableMapping):
+    """A device's configuration, stored in slots instead of a dict"""
+    __slots__ = DEVICE_FIELDS + ("extra",)
+
+    def __init__(self, device_info: Optional[Mapping[str, Any]] = None):
+        for field in DEVICE_FIELDS:
+            setattr(self, field, _MISSING)
+        self.extra = None
+        if device_info:
+            self.update(device_info)
+
+    def __getitem__(self, key: str) -> Any:
+        if key in _FIELD_SET:
+            value = getattr(self, key)
+            if value is _MISSING:
+                raise KeyError(key)
+            return value
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if key in _FIELD_SET:
+            if key in SHARED_FIELDS and isinstance(value, str):
+                value = sys.intern(value)
+            setattr(self, key, value)
+            return
+        if self.extra is None:
+            self.extra = {}
+        self.extra[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        if key in _FIELD_SET:
+            if getattr(self, key) is _MISSING:
+                raise KeyError(key)
+            setattr(self, key, _MISSING)
+            return
+        if self.extra is None:
+            raise KeyError(key)
+        del self.extra[key]
+        if not self.extra:
+            self.extra = None
+
+    def __iter__(self) -> Iterator[str]:
+        for field in DEVICE_FIELDS:
+            if getattr(self, field) is not _MISSING:
+                yield field
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self) -> int:
+        count = sum(1 for field in DEVICE_FIELDS if getattr(self, field) is not _MISSING)
+        return count + len(self.extra or ())
+
+    def __repr__(self) -> str:
+        return f"DeviceRecord({dict(self)!r})"
+
+class CompactRegistry(MutableMapping):
+    """
+    Device registry keyed by MAC address, stored as 48-bit integers.
+
+    Keys are accepted with or without colons and are always returned in the
+    AA:BB:CC:DD:EE:FF form. Keys that are not valid MAC addresses are kept
+    as uppercase strings so no record is ever dropped.
+    """
+
+    def __init__(self, devices: Optional[Mapping[str, Mapping[str, Any]]] = None):
+        self._records: Dict[int, DeviceRecord] = {}
+        self._other: Dict[str, DeviceRecord] = {}
+        if devices:
+            self.update(devices)
+
+    def __getitem__(self, mac: str) -> DeviceRecord:
+        key = mac_to_int(mac)
+        if key is None:
+            return self._other[mac.upper()]
+        return self._records[key]
+
+    def __setitem__(self, mac: str, device_info: Mapping[str, Any]) -> None:
+        record = device_info if isinstance(device_info, DeviceRecord) else DeviceRecord(device_info)
+        key = mac_to_int(mac)
+        if key is None:
+            self._other[mac.upper()] = record
+        else:
+            self._records[key] = record
+
+    def __delitem__(self, mac: str) -> None:
+        key = mac_to_int(mac)
+        if key is None:
+            del self._other[mac.upper()]
+        else:
+            del self._records[key]
+
+    def __iter__(self) -> Iterator[str]:
+        for key in self._records:
+            yield int_to_mac(key)
+        yield from self._other
+
+    def __len__(self) -> int:
+        return len(self._records) + len(self._other)
+
+    def to_dict(self) -> Dict[str, Dict[str, Any]]:
+        """Convert to the plain dict-of-dicts shape used in devices.json and the API"""
+        return {mac: dict(record) for mac, record in self.items()}
@@ -4,6 +4,10 @@ Utility functions for the OTA update server.
 import os
 import logging
 import hashlib
+from typing import Any, BinaryIO, Dict
+
+# Read size used when streaming firmware binaries
+STREAM_CHUNK_SIZE = 64 * 1024
 
 def generate_auth_token(mac_address: str, secret: str) -> str:
     """
@@ -76,6 +80,32 @@ def calculate_file_md5(filepath: str) -> str:
             hash_md5.update(chunk)
     return hash_md5.hexdigest()
 
+def stream_to_file(stream: BinaryIO, out: BinaryIO, chunk_size: int = STREAM_CHUNK_SIZE) -> Dict[str, Any]:
+    """
+    Copy a binary stream into a file, hashing it in the same pass
+    
+    Args:
+        stream: Readable binary stream (e.g., a request body)
+        out: Writable binary file object
+        chunk_size: Number of bytes to read per chunk
+        
+    Returns:
+        Dict with the MD5 and SHA-256 hex digests and the byte count
+    """
+    hash_md5 = hashlib.md5()
+    hash_sha256 = hashlib.sha256()
+    size = 0
+    for chunk in iter(lambda: stream.read(chunk_size), b""):
+        hash_md5.update(chunk)
+        hash_sha256.update(chunk)
+        out.write(chunk)
+        size += len(chunk)
+    return {
+        "md5": hash_md5.hexdigest(),
+        "sha256": hash_sha256.hexdigest(),
+        "size": size
+    }
+
 def validate_mac_address(mac: str) -> bool:
     """
     Validate MAC address format
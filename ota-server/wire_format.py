@@ -0,0 +1,212 @@
+"""
+Compact binary response encodings for the OTA update server.
+
+Clients can ask for MessagePack or CBOR instead of JSON through the Accept
+header. Both are encoded here without extra dependencies; only the types the
+API returns are supported (mappings, lists, strings, bytes, ints, floats, bools
+and None). Update check responses use short keys and are cached per release.
+"""
+import json
+import struct
+from collections.abc import Mapping
+from functools import lru_cache
+from typing import Any, Dict
+
+JSON_MIMETYPE = "application/json"
+MSGPACK_MIMETYPE = "application/msgpack"
+CBOR_MIMETYPE = "application/cbor"
+
+# Supported response types, in order of preference when the client accepts any
+RESPONSE_MIMETYPES = [JSON_MIMETYPE, MSGPACK_MIMETYPE, "application/x-msgpack", CBOR_MIMETYPE]
+
+# Short keys used for device-facing binary responses
+SHORT_KEYS = {
+    "update_available": "u",
+    "firmware_version": "v",
+    "firmware_url": "l",
+    "checksum": "c",
+    "error": "e",
+    "mac": "m",
+    "status": "s",
+    "results": "r"
+}
+
+def _pack_msgpack(obj: Any, out: bytearray) -> None:
+    """Append the MessagePack encoding of an object"""
+    if obj is None:
+        out.append(0xc0)
+    elif obj is True:
+        out.append(0xc3)
+    elif obj is False:
+        out.append(0xc2)
+    elif isinstance(obj, int):
+        if 0 <= obj < 0x80:
+            out.append(obj)
+        elif -32 <= obj < 0:
+            out.append(obj & 0xff)
+        elif obj >= 0:
+            if obj <= 0xff:
+                out += struct.pack(">BB", 0xcc, obj)
+            elif obj <= 0xffff:
+                out += struct.pack(">BH", 0xcd, obj)
+            elif obj <= 0xffffffff:
+                out += struct.pack(">BI", 0xce, obj)
+            else:
+                out += struct.pack(">BQ", 0xcf, obj)
+        elif obj >= -0x80:
+            out += struct.pack(">Bb", 0xd0, obj)
+        elif obj >= -0x8000:
+            out += struct.pack(">Bh", 0xd1, obj)
+        elif obj >= -0x80000000:
+            out += struct.pack(">Bi", 0xd2, obj)
+        else:
+            out += struct.pack(">Bq", 0xd3, obj)
+    elif isinstance(obj, float):
+        out += struct.pack(">Bd", 0xcb, obj)
+    elif isinstance(obj, str):
+        data = obj.encode('utf-8')
+        size = len(data)
+        if size < 32:
+            out.append(0xa0 | size)
+        elif size <= 0xff:
+            out += struct.pack(">BB", 0xd9, size)
+        elif size <= 0xffff:
+            out += struct.pack(">BH", 0xda, size)
+        else:
+            out += struct.pack(">BI", 0xdb, size)
+        out += data
+    elif isinstance(obj, (bytes, bytearray)):
+        size = len(obj)
+        if size <= 0xff:
+            out += struct.pack(">BB", 0xc4, size)
+        elif size <= 0xffff:
+            out += struct.pack(">BH", 0xc5, size)
+        else:
+            out += struct.pack(">BI", 0xc6, size)
+        out += obj
+    elif isinstance(obj, (list, tuple)):
+        size = len(obj)
+        if size < 16:
+            out.append(0x90 | size)
+        elif size <= 0xffff:
+            out += struct.pack(">BH", 0xdc, size)
+        else:
+            out += struct.pack(">BI", 0xdd, size)
+        for item in obj:
+            _pack_msgpack(item, out)
+    elif isinstance(obj, Mapping):
+        size = len(obj)
+        if size < 16:
+            out.append(0x80 | size)
+        elif size <= 0xffff:
+            out += struct.pack(">BH", 0xde, size)
+        else:
+            out += struct.pack(">BI", 0xdf, size)
+        for key, value in obj.items():
+            _pack_msgpack(key, out)
+            _pack_msgpack(value, out)
+    else:
+        raise TypeError(f"Cannot encode {type(obj).__name__} as MessagePack")
+
+def _cbor_head(major: int, value: int, out: bytearray) -> None:
+    """Append a CBOR initial byte and argument"""
+    if value < 24:
+        out.append(major << 5 | value)
+    elif value <= 0xff:
+        out += struct.pack(">BB", major << 5 | 24, value)
+    elif value <= 0xffff:
+        out += struct.pack(">BH", major << 5 | 25, value)
+    elif value <= 0xffffffff:
+        out += struct.pack(">BI", major << 5 | 26, value)
+    else:
+        out += struct.pack(">BQ", major << 5 | 27, value)
+
+def _pack_cbor(obj: Any, out: bytearray) -> None:
+    """Append the CBOR encoding of an object"""
+    if obj is None:
+        out.append(0xf6)
+    elif obj is True:
+        out.append(0xf5)
+    elif obj is False:
+        out.append(0xf4)
+    elif isinstance(obj, int):
+        if obj >= 0:
+            _cbor_head(0, obj, out)
+        else:
+            _cbor_head(1, -1 - obj, out)
+    elif isinstance(obj, float):
+        out += struct.pack(">Bd", 0xfb, obj)
+    elif isinstance(obj, str):
+        data = obj.encode('utf-8')
+        _cbor_head(3, len(data), out)
+        out += data
+    elif isinstance(obj, (bytes, bytearray)):
+        _cbor_head(2, len(obj), out)
+        out += obj
+    elif isinstance(obj, (list, tuple)):
+        _cbor_head(4, len(obj), out)
+        for item in obj:
+            _pack_cbor(item, out)
+    elif isinstance(obj, Mapping):
+        _cbor_head(5, len(obj), out)
+        for key, value in obj.items():
+            _pack_cbor(key, out)
+            _pack_cbor(value, out)
+    else:
+        raise TypeError(f"Cannot encode {type(obj).__name__} as CBOR")
+
+def shorten_keys(obj: Any) -> Any:
+    """Replace known field names with their short forms, recursively"""
+    if isinstance(obj, Mapping):
+        return {SHORT_KEYS.get(key, key): shorten_keys(value) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [shorten_keys(item) for item in obj]
+    return obj
+
+def encode(data: Any, mimetype: str, short_keys: bool = False) -> bytes:
+    """
+    Encode response data in the given format
+
+    Args:
+        data: Response data
+        mimetype: One of RESPONSE_MIMETYPES
+        short_keys: Whether to replace field names with their short forms
+
+    Returns:
+        Encoded response body
+    """
+    if short_keys:
+        data = shorten_keys(data)
+    out = bytearray()
+    if mimetype == CBOR_MIMETYPE:
+        _pack_cbor(data, out)
+    elif mimetype in (MSGPACK_MIMETYPE, "application/x-msgpack"):
+        _pack_msgpack(data, out)
+    else:
+        return json.dumps(data, separators=(',', ':')).encode('utf-8')
+    return bytes(out)
+
+@lru_cache(maxsize=1024)
+def _encode_cached(mimetype: str, items: tuple) -> bytes:
+    """Encode a flat response, cached by its content"""
+    return encode(dict(items), mimetype, short_keys=True)
+
+def encode_check_response(data: Dict[str, Any], mimetype: str) -> bytes:
+    """
+    Encode an update check response with short keys
+
+    Responses only vary by release (and error), so their encodings are
+    cached and reused across devices.
+
+    Args:
+        data: Response data from process_update_check
+        mimetype: One of RESPONSE_MIMETYPES
+
+    Returns:
+        Encoded response body
+    """
+    try:
+        return _encode_cached(mimetype, tuple(data.items()))
+    except TypeError:
+        # Unhashable values; encode without the cache
+        return encode(data, mimetype, short_keys=True)